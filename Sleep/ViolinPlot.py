@@ -9,11 +9,11 @@ import plotly.io as pio
 import mobile_traffic as mt
 import insee
 import numpy as np
-from tqdm import tqdm
-from datetime import date, datetime, timedelta, time
+from datetime import time
 from plotly.subplots import make_subplots
 
-from aggregate_geo import get_matching_netmob_tile_to_insee_tile, aggregate_netmob_tile_level_variables_to_insee_tile_level
+from aggregate_geo import aggregate_netmob_tile_level_traffic_data_city_to_insee_tile_level
+import time_axis
 
 data_path = '/Users/andrea/Desktop/PhD/Projects/Current/NetMob/Data/BaseData'
 figure_folder_path = '/Users/andrea/Desktop/PhD/Presentations/HTMLPresentations/reveal.js/assets/2023-10-06-Sleep/'
@@ -119,43 +119,13 @@ def sample_from_distribution(elements: np.ndarray, probabilities, n_samples: int
 
 
 def sort_times(times):
-    times_ = [time.fromisoformat(t_str) for t_str in times]
-    times_.sort(key=lambda t: _time_from_reference_time(t=t, reference_time=time(21, 0, 0)))
-    times_ = [t.isoformat() for t in times_]
-    return times_
-
-
-def _time_from_reference_time(t, reference_time):
-    auxiliary_date = date(2020, 1, 1)
-    if t < reference_time:
-        datetime.combine(auxiliary_date, t)
-        return datetime.combine(auxiliary_date, t) + timedelta(days=1) - datetime.combine(auxiliary_date, reference_time)
-    else:
-        return datetime.combine(auxiliary_date, t) - datetime.combine(auxiliary_date, reference_time)
+    return time_axis.sort_labels(labels=times, reference_time=time(21, 0, 0))
 
 
 def aggregate_data() -> xr.DataArray:
     data = xr.open_dataset(f'{data_path}/app_consumption_by_location_and_time_of_day_netmob_tile.nc')
     data = data.to_array().squeeze()
-    times = data.time.values
-    services = data.service.values
-
-    data_times = []
-    for time in tqdm(times):
-        data_time = data.sel(time=time)
-        data_time = data_time.to_pandas()
-        vars_to_aggregate = list(data_time.columns)
-        data_time_agg = aggregate_netmob_tile_level_variables_to_insee_tile_level(data=data_time, city_netmob_tile=mt.City.PARIS, variables=vars_to_aggregate, aggregation_fct='weighted_sum')
-        data_time_agg.set_index('insee_tile', inplace=True)
-        data_time_agg = data_time_agg.loc[data_time_agg['covered_area'] > 0.8].copy()
-        data_time_agg.drop(columns=['covered_area'], inplace=True)
-        data_times.append(data_time_agg)
-
-    insee_tiles = data_times[0].index
-    data_aggregated = np.stack([d.values for d in data_times], axis=-1)
-    dims = ['insee_tile', 'service', 'time']
-    coords = [insee_tiles, services, times]
-    data_aggregated = xr.DataArray(data_aggregated, dims=dims, coords=coords)
+    data_aggregated = aggregate_netmob_tile_level_traffic_data_city_to_insee_tile_level(traffic_data_netmob_tile=data, city=mt.City.PARIS)
     return data_aggregated
 
 
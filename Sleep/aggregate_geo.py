@@ -1,7 +1,14 @@
-from typing import List, Callable, Dict, Union
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Callable, Dict, Union, Tuple
 import pandas as pd
+import geopandas as gpd
+import shapely
 import numpy as np
+import scipy.sparse as sp
 import xarray as xr
+import netCDF4
 from tqdm import tqdm
 import insee
 import mobile_traffic as mt
@@ -12,33 +19,134 @@ from mobile_data import MobileData, TrafficData, ScreenTimeData
 # Matchings
 # ---------
 
+# Matchings are cached on disk, keyed by city, target geography and a fingerprint of the source geometries. Set to None to disable.
+matching_cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'sleep', 'matchings')
+
+
 def get_matching_netmob_tile_to_insee_tile(city_netmob_tile: mt.City) -> pd.DataFrame:
     city_netmob_tile_geo = mt.geo_tile.get_geo_data(city=city_netmob_tile)
+    return _get_cached_matching(name=f'{city_netmob_tile.value.lower()}_netmob_tile_to_insee_tile', source_geo=city_netmob_tile_geo, compute_matching=lambda: _compute_matching_netmob_tile_to_insee_tile(city_netmob_tile_geo=city_netmob_tile_geo))
+
+
+def get_insee_tile_area_netmob_tile_to_insee_tile(city_netmob_tile: mt.City) -> pd.Series:
+    city_netmob_tile_geo = mt.geo_tile.get_geo_data(city=city_netmob_tile)
+    insee_tile_area = _get_cached_matching(name=f'{city_netmob_tile.value.lower()}_netmob_tile_to_insee_tile_area', source_geo=city_netmob_tile_geo, compute_matching=lambda: _compute_insee_tile_area_netmob_tile_to_insee_tile(city_netmob_tile=city_netmob_tile))
+    return insee_tile_area['area']
+
+
+def get_matching_netmob_tile_to_iris(city_netmob_tile: mt.City) -> pd.DataFrame:
+    city_netmob_tile_geo = mt.geo_tile.get_geo_data(city=city_netmob_tile)
+    return _get_cached_matching(name=f'{city_netmob_tile.value.lower()}_netmob_tile_to_iris', source_geo=city_netmob_tile_geo, compute_matching=lambda: _compute_matching_netmob_tile_to_iris(city_netmob_tile_geo=city_netmob_tile_geo))
+
+
+def get_matching_netmob_tile_to_commune(city_netmob_tile: mt.City) -> pd.DataFrame:
+    city_netmob_tile_geo = mt.geo_tile.get_geo_data(city=city_netmob_tile)
+    return _get_cached_matching(name=f'{city_netmob_tile.value.lower()}_netmob_tile_to_commune', source_geo=city_netmob_tile_geo, compute_matching=lambda: _compute_matching_netmob_tile_to_commune(city_netmob_tile_geo=city_netmob_tile_geo))
+
+
+def get_matching_iris_to_commune() -> pd.DataFrame:
+    iris = insee.iris.geo.get_geo_data()
+    return _get_cached_matching(name='iris_to_commune', source_geo=iris, compute_matching=lambda: _compute_matching_iris_to_commune(iris=iris))
+
+
+def _compute_matching_netmob_tile_to_insee_tile(city_netmob_tile_geo: gpd.GeoDataFrame) -> pd.DataFrame:
     matching_netmob_tile_to_insee_tile = insee.tile.get_matching_tiles(polygons=city_netmob_tile_geo, return_intersection_area=True)
     matching_netmob_tile_to_insee_tile.rename(columns={'tile': 'insee_tile'}, inplace=True)
     return _clean_matching(matching=matching_netmob_tile_to_insee_tile, index_name='netmob_tile', column_name='insee_tile')
 
 
-def get_matching_netmob_tile_to_iris(city_netmob_tile: mt.City) -> pd.DataFrame:
-    city_netmob_tile_geo = mt.geo_tile.get_geo_data(city=city_netmob_tile)
+def _compute_insee_tile_area_netmob_tile_to_insee_tile(city_netmob_tile: mt.City) -> pd.DataFrame:
+    insee_tiles = get_matching_netmob_tile_to_insee_tile(city_netmob_tile=city_netmob_tile)['insee_tile'].unique()
+    insee_tile_area = insee.tile.get_geo_data(tile=insee_tiles).to_crs(epsg=2154).area.reindex(insee_tiles)
+    return insee_tile_area.to_frame(name='area')
+
+
+def _compute_matching_netmob_tile_to_iris(city_netmob_tile_geo: gpd.GeoDataFrame) -> pd.DataFrame:
     matching_netmob_tile_to_iris = insee.iris.geo.get_matching_iris(polygons=city_netmob_tile_geo, return_intersection_area=True)
     matching_netmob_tile_to_iris.rename(columns={'iris': 'insee_iris'}, inplace=True)
     return _clean_matching(matching=matching_netmob_tile_to_iris, index_name='netmob_tile', column_name='insee_iris')
 
 
-def get_matching_netmob_tile_to_commune(city_netmob_tile: mt.City) -> pd.DataFrame:
-    city_netmob_tile_geo = mt.geo_tile.get_geo_data(city=city_netmob_tile)
+def _compute_matching_netmob_tile_to_commune(city_netmob_tile_geo: gpd.GeoDataFrame) -> pd.DataFrame:
     matching_netmob_tile_to_commune = insee.commune.get_matching_communes(polygons=city_netmob_tile_geo, with_arrondissement_municipal=True, return_intersection_area=True)
     matching_netmob_tile_to_commune.rename(columns={'commune': 'insee_com'}, inplace=True)
     return _clean_matching(matching=matching_netmob_tile_to_commune, index_name='netmob_tile', column_name='insee_com')
 
 
-def get_matching_iris_to_commune() -> pd.DataFrame:
-    iris = insee.iris.geo.get_geo_data()
+def _compute_matching_iris_to_commune(iris: gpd.GeoDataFrame) -> pd.DataFrame:
     matching_iris_commune = insee.commune.get_matching_communes(polygons=iris, with_arrondissement_municipal=True, return_intersection_area=True)
     return _clean_matching(matching=matching_iris_commune, index_name='iris', column_name='commune')
 
 
+def _get_cached_matching(name: str, source_geo: gpd.GeoDataFrame, compute_matching: Callable[[], pd.DataFrame], target_geo: gpd.GeoDataFrame = None) -> pd.DataFrame:
+    if matching_cache_path is None:
+        return compute_matching()
+
+    fingerprint = _geometry_fingerprint(geo=source_geo) if target_geo is None else f'{_geometry_fingerprint(geo=source_geo)}_{_geometry_fingerprint(geo=target_geo)}'
+    file_path = os.path.join(matching_cache_path, f'{name}_{fingerprint}.parquet')
+    if os.path.exists(file_path):
+        return pd.read_parquet(file_path)
+
+    matching = compute_matching()
+    os.makedirs(matching_cache_path, exist_ok=True)
+    matching.to_parquet(f'{file_path}.tmp')
+    os.replace(f'{file_path}.tmp', file_path)
+    return matching
+
+
+def _geometry_fingerprint(geo: gpd.GeoDataFrame) -> str:
+    fingerprint = hashlib.sha1()
+    fingerprint.update(str(geo.crs).encode())
+    fingerprint.update('\n'.join(geo.index.astype(str)).encode())
+    fingerprint.update(b''.join(geo.geometry.to_wkb()))
+    return fingerprint.hexdigest()[:16]
+
+
+def get_matching_netmob_tile_to_custom_geography(city_netmob_tile: mt.City, target_geo: gpd.GeoDataFrame, target_name: str, n_workers: int = 1) -> pd.DataFrame:
+    city_netmob_tile_geo = mt.geo_tile.get_geo_data(city=city_netmob_tile)
+    compute_matching = lambda: get_matching(source_geo=city_netmob_tile_geo, target_geo=target_geo, source_name='netmob_tile', target_name=target_name, n_workers=n_workers)
+    return _get_cached_matching(name=f'{city_netmob_tile.value.lower()}_netmob_tile_to_{target_name}', source_geo=city_netmob_tile_geo, compute_matching=compute_matching, target_geo=target_geo)
+
+
+def get_matching(source_geo: gpd.GeoDataFrame, target_geo: gpd.GeoDataFrame, source_name: str, target_name: str, n_workers: int = 1, chunk_size: int = 10000) -> pd.DataFrame:
+    source_geometry = source_geo.to_crs(epsg=2154).geometry.values
+    target_geometry = target_geo.to_crs(epsg=2154).geometry.values
+    chunks = [source_geometry[start:start + chunk_size] for start in range(0, len(source_geometry), chunk_size)]
+    if len(chunks) == 0:
+        return pd.DataFrame({source_name: source_geo.index.values[:0], target_name: target_geo.index.values[:0], 'intersection_area': np.array([], dtype=np.float64)})
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_set_matching_target, initargs=(target_geometry,)) as executor:
+            matched_chunks = list(executor.map(_match_chunk, chunks))
+    else:
+        _set_matching_target(target_geometry=target_geometry)
+        matched_chunks = [_match_chunk(source_geometry=chunk) for chunk in chunks]
+        _set_matching_target(target_geometry=None)
+
+    offsets = np.arange(len(chunks)) * chunk_size
+    source_positions = np.concatenate([positions + offset for (positions, _, _), offset in zip(matched_chunks, offsets)])
+    target_positions = np.concatenate([positions for _, positions, _ in matched_chunks])
+    intersection_area = np.concatenate([area for _, _, area in matched_chunks])
+    matching = pd.DataFrame({source_name: source_geo.index.values[source_positions], target_name: target_geo.index.values[target_positions], 'intersection_area': intersection_area})
+    matching = matching.loc[matching['intersection_area'] > 0].reset_index(drop=True)
+    return matching
+
+
+# The target layer and its STRtree are built once per process and shared by every source chunk
+_matching_target = None
+
+
+def _set_matching_target(target_geometry: np.ndarray):
+    global _matching_target
+    _matching_target = None if target_geometry is None else (target_geometry, shapely.STRtree(target_geometry))
+
+
+def _match_chunk(source_geometry: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    target_geometry, tree = _matching_target
+    source_positions, target_positions = tree.query(source_geometry, predicate='intersects')
+    intersection_area = shapely.area(shapely.intersection(source_geometry[source_positions], target_geometry[target_positions]))
+    return source_positions, target_positions, intersection_area
+
+
 def _clean_matching(matching: pd.DataFrame, index_name: str, column_name: str):
     matching.reset_index(names=[index_name], inplace=True)
     matching = matching[[index_name, column_name, 'intersection_area']].copy()
@@ -95,24 +203,32 @@ def _add_covered_area_and_reset_index(data: pd.DataFrame, area_geo_data: pd.Data
 
 
 def perform_aggregation(data: pd.DataFrame, variables: List[str], aggregation_fct: Union[str, Dict[str, Union[Callable, str]]], group_by_var: str) -> pd.DataFrame:
-    def weighted_mean(x):
-        area = data.loc[x.index, 'intersection_area'].values
-        return np.average(x.values, weights=area)
-
-    def weighted_sum(x):
-        area_share = data.loc[x.index, 'intersection_area'].values / (100 ** 2)
-        return np.sum(x.values * area_share)
-
-    aggregation_fct_ = {v: aggregation_fct for v in variables} if isinstance(aggregation_fct, str) else aggregation_fct
-    for v, fct in aggregation_fct_.items():
-        if fct == 'weighted_mean':
-            aggregation_fct_[v] = weighted_mean
-        elif fct == 'weighted_sum':
-            aggregation_fct_[v] = weighted_sum
-
-    aggregation_fct_['intersection_area'] = "sum"
-    data_ = data.groupby(group_by_var).agg(aggregation_fct_)
-    data_.rename(columns={'intersection_area': 'covered_area'}, inplace=True)
+    aggregation_fct_ = {v: aggregation_fct for v in variables} if isinstance(aggregation_fct, str) else dict(aggregation_fct)
+    # Rows without a group are dropped, as groupby does
+    group_rows, groups = pd.factorize(data[group_by_var], sort=True)
+    data, group_rows = data.loc[group_rows >= 0], group_rows[group_rows >= 0]
+    n_groups, n_rows = len(groups), len(data)
+    area_weights = sp.csr_matrix((data['intersection_area'].to_numpy(dtype=float), (group_rows, np.arange(n_rows))), shape=(n_groups, n_rows))
+    covered_area = area_weights @ np.ones(n_rows)
+
+    weighted_sum_variables = [v for v, fct in aggregation_fct_.items() if isinstance(fct, str) and fct == 'weighted_sum']
+    weighted_mean_variables = [v for v, fct in aggregation_fct_.items() if isinstance(fct, str) and fct == 'weighted_mean']
+    other_aggregation_fct = {v: fct for v, fct in aggregation_fct_.items() if v not in weighted_sum_variables and v not in weighted_mean_variables}
+
+    aggregated = {}
+    if len(weighted_sum_variables) > 0:
+        weighted_sum = area_weights @ data[weighted_sum_variables].to_numpy(dtype=float) / (100 ** 2)
+        aggregated.update(zip(weighted_sum_variables, weighted_sum.T))
+    if len(weighted_mean_variables) > 0:
+        weighted_mean = area_weights @ data[weighted_mean_variables].to_numpy(dtype=float) / covered_area[:, np.newaxis]
+        aggregated.update(zip(weighted_mean_variables, weighted_mean.T))
+    if len(other_aggregation_fct) > 0:
+        other = data[list(other_aggregation_fct.keys())].groupby(group_rows).agg(other_aggregation_fct)
+        aggregated.update({v: other[v].values for v in other_aggregation_fct})
+
+    data_ = pd.DataFrame({v: aggregated[v] for v in aggregation_fct_}, index=pd.Index(groups, name=group_by_var))
+    data_['covered_area'] = covered_area
+    data_.sort_index(inplace=True)
     return data_
 
 # 3D aggregation
@@ -125,20 +241,259 @@ def aggregate_netmob_tile_level_traffic_data_to_insee_tile_level(traffic_data_ne
 
 
 def aggregate_netmob_tile_level_traffic_data_city_to_insee_tile_level(traffic_data_netmob_tile: xr.DataArray, city: mt.City) -> xr.DataArray:
-    times = traffic_data_netmob_tile.time.values
-    services = traffic_data_netmob_tile.service.values
-    traffic_data_insee_tiles = []
-    for t in tqdm(times):
-        traffic_data_netmob_tile_time_t = traffic_data_netmob_tile.sel(time=t).to_pandas()
-        traffic_data_insee_tile_time_t = aggregate_netmob_tile_level_variables_to_insee_tile_level(data=traffic_data_netmob_tile_time_t, city_netmob_tile=city, variables=services, aggregation_fct='weighted_sum')
-        traffic_data_insee_tile_time_t.set_index('insee_tile', inplace=True)
-        traffic_data_insee_tile_time_t = traffic_data_insee_tile_time_t.loc[traffic_data_insee_tile_time_t['covered_area'] > 0.8].copy()
-        traffic_data_insee_tile_time_t.drop(columns=['covered_area'], inplace=True)
-        traffic_data_insee_tiles.append(traffic_data_insee_tile_time_t)
-
-    insee_tiles = traffic_data_insee_tiles[0].index
-    traffic_data_insee_tiles = np.stack([d.values for d in traffic_data_insee_tiles], axis=-1)
-    dims = ['insee_tile', 'service', 'time']
-    coords = [insee_tiles, services, times]
-    traffic_data_insee_tiles = xr.DataArray(traffic_data_insee_tiles, dims=dims, coords=coords)
+    netmob_tile_dim = _get_tile_dim(data=traffic_data_netmob_tile)
+    weights, insee_tiles = get_covered_weights_netmob_tile_to_insee_tile(city_netmob_tile=city, netmob_tiles=pd.Index(traffic_data_netmob_tile[netmob_tile_dim].values))
+    traffic_data_insee_tiles = aggregate_with_weights(data=traffic_data_netmob_tile, weights=weights, target_tiles=insee_tiles, source_dim=netmob_tile_dim, target_dim='insee_tile')
+    traffic_data_insee_tiles = traffic_data_insee_tiles.transpose('insee_tile', 'service', 'time')
     return traffic_data_insee_tiles
+
+
+def aggregate_netmob_tile_level_traffic_data_city_to_levels(traffic_data_netmob_tile: xr.DataArray, city: mt.City, levels: List[str] = ('insee_tile', 'insee_iris', 'insee_com'), min_covered_area: float = 0.8) -> Dict[str, xr.DataArray]:
+    hierarchy = GeoHierarchy.for_city(city_netmob_tile=city, levels=levels)
+    netmob_tile_dim = _get_tile_dim(data=traffic_data_netmob_tile)
+    netmob_tiles = pd.Index(traffic_data_netmob_tile[netmob_tile_dim].values)
+    traffic_data_levels = {}
+    for level in levels:
+        traffic_data_level = hierarchy.aggregate(data=traffic_data_netmob_tile, source='netmob_tile', target=level, partial=True)
+        covered_area = hierarchy.covered_area(source='netmob_tile', target=level, present_tiles=netmob_tiles)
+        covered = covered_area.values / _get_level_area(city_netmob_tile=city, level=level, tiles=covered_area.index).values > min_covered_area
+        traffic_data_levels[level] = traffic_data_level.isel({level: covered}).transpose(level, 'service', 'time')
+    return traffic_data_levels
+
+
+def _get_level_area(city_netmob_tile: mt.City, level: str, tiles: pd.Index) -> pd.Series:
+    if level == 'insee_tile':
+        return get_insee_tile_area_netmob_tile_to_insee_tile(city_netmob_tile=city_netmob_tile).reindex(tiles)
+    elif level == 'insee_iris':
+        return insee.iris.geo.get_geo_data(iris=tiles).to_crs(epsg=2154).area.reindex(tiles)
+    elif level == 'insee_com':
+        return insee.commune.get_geo_data(commune_ids=tiles, with_arrondissement_municipal=True).to_crs(epsg=2154).area.reindex(tiles)
+    raise ValueError(f'Unknown level {level}')
+
+
+def aggregate_netmob_tile_level_traffic_data_file_to_insee_tile_level(source_file_path: str, target_file_path: str, city: mt.City, service_chunk_size: int = 4):
+    with xr.open_dataset(source_file_path) as source:
+        traffic_data_netmob_tile = source[list(source.data_vars)[0]]
+        netmob_tile_dim = _get_tile_dim(data=traffic_data_netmob_tile)
+        weights, insee_tiles = get_covered_weights_netmob_tile_to_insee_tile(city_netmob_tile=city, netmob_tiles=pd.Index(traffic_data_netmob_tile[netmob_tile_dim].values))
+        services, times = traffic_data_netmob_tile.service.values, traffic_data_netmob_tile.time.values
+
+        with netCDF4.Dataset(target_file_path, 'w') as target:
+            variable = _create_traffic_data_variable(target=target, coords={'insee_tile': insee_tiles.values, 'service': services, 'time': times})
+            for start in tqdm(range(0, len(services), service_chunk_size)):
+                traffic_data_chunk = traffic_data_netmob_tile.isel(service=slice(start, start + service_chunk_size)).load()
+                traffic_data_chunk = aggregate_with_weights(data=traffic_data_chunk, weights=weights, target_tiles=insee_tiles, source_dim=netmob_tile_dim, target_dim='insee_tile')
+                variable[:, start:start + traffic_data_chunk.sizes['service'], :] = traffic_data_chunk.transpose('insee_tile', 'service', 'time').values
+
+
+def reaggregate_netmob_tile_level_traffic_data_file_to_insee_tile_level(source_file_path: str, target_file_path: str, city: mt.City, services: List[str] = None, times: List[str] = None, mass_tolerance: float = 1e-6) -> float:
+    selection = {dim: labels for dim, labels in [('service', services), ('time', times)] if labels is not None}
+    with xr.open_dataset(source_file_path) as source:
+        traffic_data_netmob_tile = source[list(source.data_vars)[0]]
+        netmob_tile_dim = _get_tile_dim(data=traffic_data_netmob_tile)
+        weights, insee_tiles = get_covered_weights_netmob_tile_to_insee_tile(city_netmob_tile=city, netmob_tiles=pd.Index(traffic_data_netmob_tile[netmob_tile_dim].values))
+        traffic_data_netmob_tile = traffic_data_netmob_tile.sel(selection).transpose(netmob_tile_dim, 'service', 'time').load()
+    traffic_data_insee_tile = aggregate_with_weights(data=traffic_data_netmob_tile, weights=weights, target_tiles=insee_tiles, source_dim=netmob_tile_dim, target_dim='insee_tile').transpose('insee_tile', 'service', 'time')
+
+    # Everything is validated before the target is opened for writing, so a failed check leaves the file untouched
+    with netCDF4.Dataset(target_file_path, 'r') as target:
+        if not np.array_equal(target['insee_tile'][:].astype(str), insee_tiles.values.astype(str)):
+            raise ValueError(f'The insee tiles of {target_file_path} differ from the current matching, re-aggregate the whole city instead')
+        service_positions = _get_positions(labels=target['service'][:], selected=traffic_data_insee_tile.service.values)
+        time_positions = _get_positions(labels=target['time'][:], selected=traffic_data_insee_tile.time.values)
+
+    # The expected traffic comes from the cached matching, independently of the weight matrix used for the aggregation
+    covered_share = get_covered_share_netmob_tile_to_insee_tile(city_netmob_tile=city, insee_tiles=insee_tiles)
+    relative_mass_error = mass_conservation_error(traffic_data_netmob_tile=traffic_data_netmob_tile, traffic_data_insee_tile=traffic_data_insee_tile.values, covered_share=covered_share)
+    if relative_mass_error > mass_tolerance:
+        raise ValueError(f'Traffic is not conserved when patching {target_file_path}: relative error {relative_mass_error:.2e}')
+
+    service_order, time_order = np.argsort(service_positions), np.argsort(time_positions)
+    slab = (slice(None), service_positions[service_order], time_positions[time_order])
+    with netCDF4.Dataset(target_file_path, 'a') as target:
+        variable = target['__xarray_dataarray_variable__']
+        previous_values = variable[slab]
+        variable[slab] = traffic_data_insee_tile.values[:, service_order][:, :, time_order]
+
+    # The slab is read back from disk and checked again, the previous values are restored if it does not conserve traffic
+    with netCDF4.Dataset(target_file_path, 'r') as target:
+        patched_values = np.ma.filled(target['__xarray_dataarray_variable__'][slab].astype(np.float64), np.nan)
+    patched_values = patched_values[:, np.argsort(service_order)][:, :, np.argsort(time_order)]
+    patched_mass_error = mass_conservation_error(traffic_data_netmob_tile=traffic_data_netmob_tile, traffic_data_insee_tile=patched_values, covered_share=covered_share)
+    if patched_mass_error > mass_tolerance:
+        with netCDF4.Dataset(target_file_path, 'a') as target:
+            target['__xarray_dataarray_variable__'][slab] = previous_values
+        raise ValueError(f'Traffic is not conserved in the patched {target_file_path}: relative error {patched_mass_error:.2e}, the previous values were restored')
+    return patched_mass_error
+
+
+def get_covered_share_netmob_tile_to_insee_tile(city_netmob_tile: mt.City, insee_tiles: pd.Index) -> pd.Series:
+    matching_netmob_tile_to_insee_tile = get_matching_netmob_tile_to_insee_tile(city_netmob_tile=city_netmob_tile)
+    matching_netmob_tile_to_insee_tile = matching_netmob_tile_to_insee_tile.loc[matching_netmob_tile_to_insee_tile['insee_tile'].isin(insee_tiles)]
+    return matching_netmob_tile_to_insee_tile.groupby('netmob_tile')['intersection_area'].sum() / (100 ** 2)
+
+
+def mass_conservation_error(traffic_data_netmob_tile: xr.DataArray, traffic_data_insee_tile: np.ndarray, covered_share: pd.Series) -> float:
+    # Per service and time, each netmob tile contributes its traffic times the share of its area inside the kept insee
+    # tiles. A missing value makes the whole service and time missing on both sides, so the NaN positions must match too
+    netmob_tile_dim = _get_tile_dim(data=traffic_data_netmob_tile)
+    share = covered_share.reindex(traffic_data_netmob_tile[netmob_tile_dim].values).fillna(0).values
+    source_values = np.asarray(traffic_data_netmob_tile.transpose(netmob_tile_dim, 'service', 'time').values)
+    source_values = source_values.reshape(source_values.shape[0], -1)[share > 0]
+    expected_total = share[share > 0] @ source_values
+    aggregated_total = np.asarray(traffic_data_insee_tile).reshape(traffic_data_insee_tile.shape[0], -1).sum(axis=0)
+    if not np.array_equal(np.isnan(expected_total), np.isnan(aggregated_total)):
+        return np.inf
+    expected_total, aggregated_total = np.nansum(expected_total), np.nansum(aggregated_total)
+    return abs(aggregated_total - expected_total) / max(abs(expected_total), np.finfo(float).tiny)
+
+
+def _get_positions(labels: np.ndarray, selected: np.ndarray) -> np.ndarray:
+    positions = pd.Index(np.asarray(labels).astype(str)).get_indexer(np.asarray(selected).astype(str))
+    if (positions < 0).any():
+        raise ValueError(f'Labels {np.asarray(selected)[positions < 0]} are missing from the insee tile file')
+    return positions
+
+
+def _create_traffic_data_variable(target: netCDF4.Dataset, coords: Dict[str, np.ndarray]) -> netCDF4.Variable:
+    # Mirrors the layout of DataArray.to_netcdf so that MobileData.load_dataset reads the file unchanged
+    for dim, values in coords.items():
+        target.createDimension(dim, len(values))
+        coord = target.createVariable(dim, str if values.dtype.kind in 'OU' else values.dtype, (dim,))
+        coord[:] = values.astype(object) if values.dtype.kind in 'OU' else values
+    chunk_sizes = (len(coords['insee_tile']), 1, len(coords['time']))
+    return target.createVariable('__xarray_dataarray_variable__', 'f8', tuple(coords.keys()), chunksizes=chunk_sizes)
+
+
+def _get_tile_dim(data: xr.DataArray) -> str:
+    return [d for d in data.dims if d not in ['service', 'time']][0]
+
+
+# Sparse aggregation
+# ---------------
+
+def get_covered_weights_netmob_tile_to_insee_tile(city_netmob_tile: mt.City, netmob_tiles: pd.Index, min_covered_area: float = 0.8) -> Tuple[sp.csr_matrix, pd.Index]:
+    # Only the area of the netmob tiles present in the data counts as covered, as in the per-time groupby this replaces.
+    # The tile areas depend only on geometry and are cached per city
+    weights, insee_tiles, covered_area = get_weights_netmob_tile_to_insee_tile(city_netmob_tile=city_netmob_tile, netmob_tiles=netmob_tiles)
+    covered = covered_area / get_insee_tile_area_netmob_tile_to_insee_tile(city_netmob_tile=city_netmob_tile).reindex(insee_tiles).values > min_covered_area
+    return weights[covered], insee_tiles[covered]
+
+
+def get_weights_netmob_tile_to_insee_tile(city_netmob_tile: mt.City, netmob_tiles: pd.Index) -> Tuple[sp.csr_matrix, pd.Index, np.ndarray]:
+    matching_netmob_tile_to_insee_tile = get_matching_netmob_tile_to_insee_tile(city_netmob_tile=city_netmob_tile)
+    return build_weights(matching=matching_netmob_tile_to_insee_tile, source_tiles=netmob_tiles, source_name='netmob_tile', target_name='insee_tile')
+
+
+def build_weights(matching: pd.DataFrame, source_tiles: pd.Index, source_name: str, target_name: str, source_area: Union[float, pd.Series] = 100 ** 2) -> Tuple[sp.csr_matrix, pd.Index, np.ndarray]:
+    matching = matching.loc[matching[source_name].isin(source_tiles)]
+    intersection_area = matching['intersection_area'].values
+    source_area = source_area.reindex(matching[source_name]).values if isinstance(source_area, pd.Series) else source_area
+    source_codes = source_tiles.get_indexer(matching[source_name])
+    target_codes, target_tiles = pd.factorize(matching[target_name], sort=True)
+    weights = sp.csr_matrix((intersection_area / source_area, (target_codes, source_codes)), shape=(len(target_tiles), len(source_tiles)))
+    covered_area = np.bincount(target_codes, weights=intersection_area, minlength=len(target_tiles))
+    return weights, pd.Index(target_tiles, name=target_name), covered_area
+
+
+def aggregate_with_weights(data: xr.DataArray, weights: sp.csr_matrix, target_tiles: pd.Index, source_dim: str, target_dim: str) -> xr.DataArray:
+    data = data.transpose(source_dim, ...)
+    # A missing source value makes every target it overlaps missing, as the weighted sum of the 2d aggregation does
+    values = np.asarray(data.values)
+    aggregated = weights @ values.reshape(values.shape[0], -1)
+    aggregated = aggregated.reshape((weights.shape[0],) + values.shape[1:])
+    dims = [target_dim] + list(data.dims[1:])
+    coords = [target_tiles] + [data[d].values for d in data.dims[1:]]
+    return xr.DataArray(aggregated, dims=dims, coords=coords)
+
+
+# Hierarchical aggregation
+# ---------------
+
+class GeoHierarchy:
+    # Operators map the tiles of a finer level onto the tiles of a coarser one, weighted by the share of each source tile inside each target tile
+    def __init__(self):
+        self._operators: Dict[Tuple[str, str], Tuple[sp.csr_matrix, pd.Index, pd.Index]] = {}
+        self._edges: Dict[str, List[str]] = {}
+
+    @classmethod
+    def for_city(cls, city_netmob_tile: mt.City, levels: List[str] = ('insee_tile', 'insee_iris', 'insee_com')) -> 'GeoHierarchy':
+        # Only the matchings needed for the requested levels are computed. Communes are reached through the iris, so
+        # there is no netmob tile to commune spatial join, and the iris to commune matching is shared by all cities
+        hierarchy = cls()
+        if 'insee_tile' in levels:
+            matching_netmob_tile_to_insee_tile = get_matching_netmob_tile_to_insee_tile(city_netmob_tile=city_netmob_tile)
+            hierarchy.add_matching(matching=matching_netmob_tile_to_insee_tile, source='netmob_tile', target='insee_tile')
+        if 'insee_iris' not in levels and 'insee_com' not in levels:
+            return hierarchy
+
+        matching_netmob_tile_to_iris = get_matching_netmob_tile_to_iris(city_netmob_tile=city_netmob_tile)
+        hierarchy.add_matching(matching=matching_netmob_tile_to_iris, source='netmob_tile', target='insee_iris')
+        if 'insee_com' not in levels:
+            return hierarchy
+
+        matching_iris_to_commune = get_matching_iris_to_commune().rename(columns={'iris': 'insee_iris', 'commune': 'insee_com'})
+        matching_iris_to_commune = matching_iris_to_commune.loc[matching_iris_to_commune['insee_iris'].isin(matching_netmob_tile_to_iris['insee_iris'])]
+        iris_area = insee.iris.geo.get_geo_data(iris=matching_iris_to_commune['insee_iris'].unique()).to_crs(epsg=2154).area
+        hierarchy.add_matching(matching=matching_iris_to_commune, source='insee_iris', target='insee_com', source_area=iris_area)
+        return hierarchy
+
+    def add_matching(self, matching: pd.DataFrame, source: str, target: str, source_area: Union[float, pd.Series] = 100 ** 2):
+        source_tiles = pd.Index(np.sort(matching[source].unique()), name=source)
+        weights, target_tiles, _ = build_weights(matching=matching, source_tiles=source_tiles, source_name=source, target_name=target, source_area=source_area)
+        self.add_operator(source=source, target=target, weights=weights, source_tiles=source_tiles, target_tiles=target_tiles)
+
+    def add_operator(self, source: str, target: str, weights: sp.csr_matrix, source_tiles: pd.Index, target_tiles: pd.Index):
+        self._operators[(source, target)] = (weights, source_tiles, target_tiles)
+        self._edges.setdefault(source, []).append(target)
+
+    def operator(self, source: str, target: str) -> Tuple[sp.csr_matrix, pd.Index, pd.Index]:
+        if (source, target) not in self._operators:
+            path = self._find_path(source=source, target=target)
+            weights, source_tiles, target_tiles = self._operators[(path[0], path[1])]
+            for level, next_level in zip(path[1:-1], path[2:]):
+                next_weights, next_source_tiles, next_target_tiles = self._operators[(level, next_level)]
+                weights = next_weights @ self._align(weights=weights, tiles=target_tiles, to_tiles=next_source_tiles)
+                target_tiles = next_target_tiles
+            self._operators[(source, target)] = (weights.tocsr(), source_tiles, target_tiles)
+        return self._operators[(source, target)]
+
+    def _find_path(self, source: str, target: str) -> List[str]:
+        paths = [[source]]
+        while len(paths) > 0:
+            path = paths.pop(0)
+            if path[-1] == target:
+                return path
+            paths += [path + [level] for level in self._edges.get(path[-1], []) if level not in path]
+        raise ValueError(f'No aggregation path from {source} to {target}')
+
+    @staticmethod
+    def _align(weights: sp.csr_matrix, tiles: pd.Index, to_tiles: pd.Index) -> sp.csr_matrix:
+        positions = tiles.get_indexer(to_tiles)
+        rows = np.flatnonzero(positions >= 0)
+        selection = sp.csr_matrix((np.ones(len(rows)), (rows, positions[rows])), shape=(len(to_tiles), len(tiles)))
+        return selection @ weights
+
+    def aggregate(self, data: xr.DataArray, source: str, target: str, partial: bool = False) -> xr.DataArray:
+        # A target that overlaps a source tile missing from the data is NaN, unless partial is set, in which case it sums the
+        # tiles that are present and the caller is expected to filter targets on covered_area(present_tiles=...)
+        weights, source_tiles, target_tiles = self.operator(source=source, target=target)
+        source_dim = _get_tile_dim(data=data)
+        positions = source_tiles.get_indexer(data[source_dim].values)
+        in_operator = positions >= 0
+        data = data.isel({source_dim: np.flatnonzero(in_operator)})
+        aggregated = aggregate_with_weights(data=data, weights=weights[:, positions[in_operator]], target_tiles=target_tiles, source_dim=source_dim, target_dim=target)
+        if partial:
+            return aggregated
+        missing = np.ones(len(source_tiles), dtype=bool)
+        missing[positions[in_operator]] = False
+        incomplete = np.asarray(weights[:, np.flatnonzero(missing)].sum(axis=1)).ravel() > 0
+        return aggregated.where(xr.DataArray(~incomplete, dims=[target]))
+
+    def covered_area(self, source: str, target: str, source_area: Union[float, pd.Series] = 100 ** 2, present_tiles: pd.Index = None) -> pd.Series:
+        weights, source_tiles, target_tiles = self.operator(source=source, target=target)
+        source_area = source_area.reindex(source_tiles).values if isinstance(source_area, pd.Series) else np.full(len(source_tiles), source_area)
+        if present_tiles is not None:
+            source_area = np.where(source_tiles.isin(present_tiles), source_area, 0)
+        return pd.Series(weights @ source_area, index=target_tiles, name='covered_area')
+
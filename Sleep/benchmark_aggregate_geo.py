@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import time
+import resource
+import tracemalloc
+import subprocess
+from datetime import datetime
+from typing import Callable, Dict, List, Any, Tuple
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import xarray as xr
+from shapely.geometry import box
+
+from aggregate_geo import get_matching, perform_aggregation, build_weights, aggregate_with_weights, _merge_data_and_matching
+
+benchmark_results_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results')
+
+
+# Synthetic geometries
+# ---------------
+
+def generate_square_grid(n_tiles_side: int, tile_size: float, name: str, offset: float = 0) -> gpd.GeoDataFrame:
+    xs, ys = np.meshgrid(np.arange(n_tiles_side) * tile_size + offset, np.arange(n_tiles_side) * tile_size + offset)
+    geometry = [box(x, y, x + tile_size, y + tile_size) for x, y in zip(xs.ravel(), ys.ravel())]
+    index = pd.Index([f'{name}_{k}' for k in range(len(geometry))], name=name)
+    return gpd.GeoDataFrame(geometry=geometry, index=index, crs='EPSG:2154')
+
+
+def generate_source_and_target_grids(n_tiles_side: int) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
+    # NetMob-like 100m source tiles and INSEE-like 200m target tiles shifted by half a source tile
+    source = generate_square_grid(n_tiles_side=n_tiles_side, tile_size=100, name='netmob_tile')
+    target = generate_square_grid(n_tiles_side=n_tiles_side // 2 + 1, tile_size=200, name='insee_tile', offset=-50)
+    return source, target
+
+
+# Benchmarks
+# ---------------
+
+def measure(fct: Callable[[], Any]) -> Tuple[Any, float, Dict[str, float]]:
+    # tracemalloc only sees the Python allocators, so the GEOS and BLAS buffers are invisible to it. The process maximum
+    # resident set size covers them, but it is a high-water mark over the whole run rather than a per-step peak
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = fct()
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    memory = {'peak_python_heap_mb': peak / 1024 ** 2, 'max_rss_mb': max_rss_mb()}
+    return result, seconds, memory
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def benchmark_grid(n_tiles_side: int, n_services: int, n_times: int) -> List[Dict[str, Any]]:
+    source, target = generate_source_and_target_grids(n_tiles_side=n_tiles_side)
+    n_source_tiles = len(source)
+    services = [f'service_{k}' for k in range(n_services)]
+    cube = xr.DataArray(np.random.rand(n_source_tiles, n_services, n_times), dims=['netmob_tile', 'service', 'time'], coords=[source.index, services, np.arange(n_times)])
+
+    matching, seconds_matching, memory_matching = measure(fct=lambda: get_matching(source_geo=source, target_geo=target, source_name='netmob_tile', target_name='insee_tile'))
+
+    data_2d = cube.isel(time=0).to_pandas()
+    _, seconds_2d, memory_2d = measure(fct=lambda: perform_aggregation(data=_merge_data_and_matching(data=data_2d, matching=matching.set_index('netmob_tile'), column_drop_na='insee_tile'), variables=services, aggregation_fct='weighted_sum', group_by_var='insee_tile'))
+
+    def aggregate_3d():
+        weights, insee_tiles, _ = build_weights(matching=matching, source_tiles=source.index, source_name='netmob_tile', target_name='insee_tile')
+        return aggregate_with_weights(data=cube, weights=weights, target_tiles=insee_tiles, source_dim='netmob_tile', target_dim='insee_tile')
+
+    _, seconds_3d, memory_3d = measure(fct=aggregate_3d)
+
+    # The rate of each step is measured in the values it processes: tiles for the matching, tile x service cells for
+    # the 2d aggregation and the whole cube for the 3d one
+    results = []
+    steps = [('matching', n_source_tiles, seconds_matching, memory_matching), ('aggregation_2d', n_source_tiles * n_services, seconds_2d, memory_2d), ('aggregation_3d', cube.size, seconds_3d, memory_3d)]
+    for step, n_values, seconds, memory in steps:
+        results.append({'step': step, 'n_source_tiles': n_source_tiles, 'n_target_tiles': len(target), 'n_services': n_services, 'n_times': n_times, 'n_values': n_values, 'seconds': seconds, 'values_per_second': n_values / seconds, **memory})
+    return results
+
+
+def run_benchmarks(n_tiles_side_list: List[int], n_services: int = 20, n_times: int = 96) -> pd.DataFrame:
+    results = []
+    for n_tiles_side in n_tiles_side_list:
+        results += benchmark_grid(n_tiles_side=n_tiles_side, n_services=n_services, n_times=n_times)
+    results = pd.DataFrame(results)
+    save_results(results=results)
+    return results
+
+
+def save_results(results: pd.DataFrame):
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    results = results.assign(commit=commit, timestamp=datetime.now().isoformat(timespec='seconds'))
+    os.makedirs(benchmark_results_path, exist_ok=True)
+    with open(os.path.join(benchmark_results_path, 'aggregate_geo.jsonl'), 'a') as f:
+        for record in results.to_dict(orient='records'):
+            f.write(json.dumps(record) + '\n')
+
+
+def load_results() -> pd.DataFrame:
+    return pd.read_json(os.path.join(benchmark_results_path, 'aggregate_geo.jsonl'), lines=True)
+
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] if len(sys.argv) > 1 else [50, 100, 200]
+    res = run_benchmarks(n_tiles_side_list=sizes)
+    print(res.to_string(index=False))
@@ -1,36 +1,117 @@
+import os
 import sys
+from typing import List
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import mobile_traffic as mt
 import pandas as pd
+import numpy as np
 import xarray as xr
-from datetime import datetime
 
-from aggregate_geo import aggregate_netmob_tile_level_traffic_data_city_to_insee_tile_level
+from aggregate_geo import aggregate_netmob_tile_level_traffic_data_city_to_insee_tile_level, aggregate_netmob_tile_level_traffic_data_city_to_levels, aggregate_netmob_tile_level_traffic_data_file_to_insee_tile_level, reaggregate_netmob_tile_level_traffic_data_file_to_insee_tile_level
 import transform
 from mobile_data import MobileData, TrafficData, ScreenTimeData
 import robustness
+import time_axis
 
 
-def aggregate_and_save_netmob_tile_to_insee_tile(folder_path: str, city: mt.City):
+robustness_seed = 0
+
+
+def aggregate_and_save_netmob_tile_to_insee_tile(folder_path: str, city: mt.City, service_chunk_size: int = None):
     file_path = f'{folder_path}/mobile_traffic_{city.value.lower()}_by_netmob_tile_service_and_time.nc'
+    if service_chunk_size is not None:
+        aggregate_netmob_tile_level_traffic_data_file_to_insee_tile_level(source_file_path=file_path, target_file_path=f'{folder_path}/mobile_traffic_{city.value.lower()}_by_insee_tile_service_and_time.nc', city=city, service_chunk_size=service_chunk_size)
+        return
+
     data_city = load_netmob_tile_dataset_city(file_path=file_path)
     agg = aggregate_netmob_tile_level_traffic_data_city_to_insee_tile_level(traffic_data_netmob_tile=data_city, city=city)
-    time_as_str = [str(t) for t in agg.time.values]
+    time_as_str = time_axis.minutes_to_labels(minutes=agg.time.values)
     agg = agg.assign_coords(time=time_as_str)
     agg.to_netcdf(f'{folder_path}/mobile_traffic_{city.value.lower()}_by_insee_tile_service_and_time.nc')
 
 
+def aggregate_and_save_netmob_tile_to_levels(folder_path: str, city: mt.City, levels: List[str] = ('insee_tile', 'insee_iris', 'insee_com')):
+    file_path = f'{folder_path}/mobile_traffic_{city.value.lower()}_by_netmob_tile_service_and_time.nc'
+    data = load_netmob_tile_dataset_city(file_path=file_path)
+    aggregated = aggregate_netmob_tile_level_traffic_data_city_to_levels(traffic_data_netmob_tile=data, city=city, levels=levels)
+    for level, agg in aggregated.items():
+        agg = agg.assign_coords(time=time_axis.minutes_to_labels(minutes=agg.time.values))
+        agg.to_netcdf(f'{folder_path}/mobile_traffic_{city.value.lower()}_by_{level}_service_and_time.nc')
+
+
+def reaggregate_and_patch_netmob_tile_to_insee_tile(folder_path: str, city: mt.City, services: List[mt.Service] = None, times: List[str] = None) -> float:
+    source_file_path = f'{folder_path}/mobile_traffic_{city.value.lower()}_by_netmob_tile_service_and_time.nc'
+    target_file_path = f'{folder_path}/mobile_traffic_{city.value.lower()}_by_insee_tile_service_and_time.nc'
+    services = None if services is None else [s.value for s in services]
+    return reaggregate_netmob_tile_level_traffic_data_file_to_insee_tile_level(source_file_path=source_file_path, target_file_path=target_file_path, city=city, services=services, times=times)
+
+
+def aggregate_and_save_netmob_tile_to_insee_tile_all_cities(folder_path: str, cities: List[mt.City] = None, n_workers: int = 1, memory_budget_gb: float = 8, service_chunk_size: int = None):
+    cities = list(mt.City) if cities is None else cities
+    memory_estimates = {city: estimate_aggregation_memory_gb(folder_path=folder_path, city=city, service_chunk_size=service_chunk_size) for city in cities}
+    pending = sorted(cities, key=lambda c: memory_estimates[c], reverse=True)
+    in_flight = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        while len(pending) > 0 or len(in_flight) > 0:
+            memory_in_flight = sum(memory_estimates[c] for c in in_flight.values())
+            while len(pending) > 0 and len(in_flight) < n_workers:
+                city = next((c for c in pending if memory_in_flight + memory_estimates[c] <= memory_budget_gb), None)
+                if city is None and len(in_flight) == 0:
+                    city = pending[0]
+                if city is None:
+                    break
+                pending.remove(city)
+                in_flight[executor.submit(aggregate_and_save_netmob_tile_to_insee_tile, folder_path=folder_path, city=city, service_chunk_size=service_chunk_size)] = city
+                memory_in_flight += memory_estimates[city]
+
+            done, _ = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+                print('AGGREGATED CITY: ', in_flight.pop(future).value)
+
+
+def estimate_aggregation_memory_gb(folder_path: str, city: mt.City, service_chunk_size: int = None) -> float:
+    # The netmob tile cube, its insee tile aggregate and the transient matrix product are resident at once
+    file_path = f'{folder_path}/mobile_traffic_{city.value.lower()}_by_netmob_tile_service_and_time.nc'
+    with xr.open_dataset(file_path) as dataset:
+        share_in_memory = 1 if service_chunk_size is None else min(1, service_chunk_size / dataset.sizes['service'])
+        return 2.5 * share_in_memory * dataset.nbytes / 1024 ** 3
+
+
+def get_memory_budget_gb() -> float:
+    mem_per_cpu_mb = float(os.environ.get('SLURM_MEM_PER_CPU', 8 * 1024))
+    return mem_per_cpu_mb * len(os.sched_getaffinity(0)) / 1024
+
+
+def get_n_workers() -> int:
+    return len(os.sched_getaffinity(0))
+
+
 def load_netmob_tile_dataset_city(file_path: str):
     data_city = xr.open_dataset(file_path).to_array().squeeze()
-    data_city = data_city.assign_coords(time=[datetime.strptime(t, '%H:%M:%S').time() for t in data_city.time.values])
+    data_city = data_city.assign_coords(time=time_axis.labels_to_minutes(labels=data_city.time.values))
     return data_city
 
 
+def load_traffic_data(folder_data: str, service: List[mt.Service]) -> TrafficData:
+    store_path = f'{folder_data}/traffic_store'
+    # The store is only reused while the city files it was built from are unchanged, e.g. not patched by reaggregate
+    source_file_paths = TrafficData.get_dataset_file_paths(synthetic=False, insee_tiles=True, folder_path=folder_data)
+    if TrafficData.is_store_valid(store_path=store_path, service=service, source_file_paths=source_file_paths):
+        return TrafficData.from_store(store_path=store_path, service=service)
+
+    traffic_data = TrafficData.load_dataset(synthetic=False, insee_tiles=True, folder_path=folder_data, service=service, n_workers=get_n_workers())
+    traffic_data.to_store(store_path=store_path, source_file_paths=source_file_paths)
+    return traffic_data
+
+
 def get_base_data(folder_data: str):
     income_quantiles = [0.3, 0.7]
     n_sample_screen_time_robustness = 15
-    traffic_data = TrafficData.load_dataset(synthetic=False, insee_tiles=True, folder_path=folder_data)
-    screen_time_data = robustness.screen_time_data_sample__individual(traffic_data=traffic_data, traffic_per_minute_sampler=robustness.service_traffic_per_minute_sampler())
+    traffic_per_minute_sampler = robustness.service_traffic_per_minute_sampler()
+    traffic_data = load_traffic_data(folder_data=folder_data, service=list(traffic_per_minute_sampler.keys())).stack()
+    screen_time_data = robustness.screen_time_data_sample__individual(traffic_data=traffic_data, traffic_per_minute_sampler=traffic_per_minute_sampler, rng=np.random.default_rng(robustness_seed))
     return traffic_data, screen_time_data, income_quantiles, n_sample_screen_time_robustness
 
 
@@ -40,6 +121,7 @@ def generate_and_save_other_figure_data(folder_save: str, folder_data: str):
     nsi_income_tile_geo = transform.night_screen_index_income_category_and_tile_geo(screen_time_data=screen_time_data, income_quantiles=income_quantiles)
     nsi_for_services = transform.night_screen_index_for_services(screen_time_data=screen_time_data)
     rca_income_time = transform.rca_income_and_time(screen_time_data=screen_time_data, income_quantiles=income_quantiles)
+    rca_income_time.columns = time_axis.minutes_to_labels(minutes=rca_income_time.columns)
 
     nsi_income_tile_geo.to_file(f'{folder_save}/nsi_income_tile_geo.geojson', driver='GeoJSON')
     nsi_for_services.to_csv(f'{folder_save}/nsi_for_services.csv', index=False)
@@ -50,21 +132,39 @@ def generate_and_save_nsi_robustness_checks_data(folder_save: str, folder_data:
     traffic_data, screen_time_data, income_quantiles, n_sample_screen_time_robustness = get_base_data(folder_data=folder_data)
 
     nsi_income = transform.night_screen_index_and_log2_income(screen_time_data=screen_time_data)
-    nsi_income_robustness__screen_time_data = transform.night_screen_index_and_log2_income_robustness__screen_time(traffic_data=traffic_data, income_quantiles=income_quantiles, n_samples=n_sample_screen_time_robustness)
-    nsi_income_robustness__amenity_data = transform.night_screen_index_and_log2_income_robustness__amenity(screen_time_data=screen_time_data, income_quantiles=income_quantiles)
+    nsi_income_robustness__amenity_data = transform.night_screen_index_and_log2_income_robustness__amenity(screen_time_data=screen_time_data, income_quantiles=income_quantiles, n_workers=get_n_workers())
+    for sampling_technique in robustness.SamplingTechnique:
+        nsi_income_robustness__screen_time_data = transform.night_screen_index_and_log2_income_robustness__screen_time(traffic_data=traffic_data, income_quantiles=income_quantiles, n_samples=n_sample_screen_time_robustness, sampling_technique=sampling_technique, seed=robustness_seed, n_workers=get_n_workers())
+        nsi_income_robustness__screen_time_data.to_csv(f'{folder_save}/nsi_income_robustness__screen_time__{sampling_technique.value}_sampling.csv')
 
     nsi_income.to_csv(f'{folder_save}/nsi_income.csv')
-    nsi_income_robustness__screen_time_data.to_csv(f'{folder_save}/nsi_income_robustness__screen_time.csv')
     nsi_income_robustness__amenity_data.to_csv(f'{folder_save}/nsi_income_robustness__amenity.csv')
 
 
+def generate_and_save_adaptive_robustness_checks_data(folder_save: str, folder_data: str, target_standard_error: float, max_samples: int = 1000, max_time_s: float = 6 * 3600):
+    traffic_data, screen_time_data, income_quantiles, n_sample_screen_time_robustness = get_base_data(folder_data=folder_data)
+
+    reports = {}
+    for sampling_technique in robustness.SamplingTechnique:
+        nsi_income_robustness, reports[f'nsi_{sampling_technique.value}'] = transform.night_screen_index_and_log2_income_robustness__screen_time__adaptive(traffic_data=traffic_data, income_quantiles=income_quantiles, sampling_technique=sampling_technique, target_standard_error=target_standard_error, max_samples=max_samples, max_time_s=max_time_s, seed=robustness_seed, n_workers=get_n_workers())
+        rca_income_service_robustness, reports[f'rca_{sampling_technique.value}'] = transform.rca_income_and_services_robustness__screen_time__adaptive(traffic_data=traffic_data, income_quantiles=income_quantiles, sampling_technique=sampling_technique, target_standard_error=target_standard_error, max_samples=max_samples, max_time_s=max_time_s, seed=robustness_seed, n_workers=get_n_workers())
+        rca_income_service_robustness.index = rca_income_service_robustness.index.set_levels([s.value if isinstance(s, mt.Service) else s for s in rca_income_service_robustness.index.levels[1]], level=1)
+
+        nsi_income_robustness.to_csv(f'{folder_save}/nsi_income_robustness__screen_time__{sampling_technique.value}_sampling__adaptive.csv')
+        rca_income_service_robustness.to_csv(f'{folder_save}/rca_income_service_robustness__screen_time__{sampling_technique.value}__adaptive.csv')
+
+    reports = pd.DataFrame.from_dict(reports, orient='index')
+    print('ROBUSTNESS PRECISION:\n', reports.to_string())
+    reports.to_csv(f'{folder_save}/robustness__screen_time__adaptive_precision.csv')
+
+
 def generate_and_save_rca_robustness_checks_data(folder_save: str, folder_data: str):
     traffic_data, screen_time_data, income_quantiles, n_sample_screen_time_robustness = get_base_data(folder_data=folder_data)
 
     rca_income_service_data = transform.rca_income_and_services(mobile_data=screen_time_data, income_quantiles=income_quantiles)
-    rca_income_service_robustness__screen_time_data__individual = transform.rca_income_and_services_robustness__screen_time(traffic_data=traffic_data, income_quantiles=income_quantiles, n_samples=n_sample_screen_time_robustness, sampling_technique=robustness.SamplingTechnique.INDIVIDUAL)
-    rca_income_service_robustness__screen_time_data__mean = transform.rca_income_and_services_robustness__screen_time(traffic_data=traffic_data, income_quantiles=income_quantiles, n_samples=n_sample_screen_time_robustness, sampling_technique=robustness.SamplingTechnique.MEAN)
-    rca_income_service_robustness__amenity_data = transform.rca_income_and_services_robustness__amenity(screen_time_data=screen_time_data, income_quantiles=income_quantiles)
+    rca_income_service_robustness__screen_time_data__individual = transform.rca_income_and_services_robustness__screen_time(traffic_data=traffic_data, income_quantiles=income_quantiles, n_samples=n_sample_screen_time_robustness, sampling_technique=robustness.SamplingTechnique.INDIVIDUAL, seed=robustness_seed, n_workers=get_n_workers())
+    rca_income_service_robustness__screen_time_data__mean = transform.rca_income_and_services_robustness__screen_time(traffic_data=traffic_data, income_quantiles=income_quantiles, n_samples=n_sample_screen_time_robustness, sampling_technique=robustness.SamplingTechnique.MEAN, seed=robustness_seed, n_workers=get_n_workers())
+    rca_income_service_robustness__amenity_data = transform.rca_income_and_services_robustness__amenity(screen_time_data=screen_time_data, income_quantiles=income_quantiles, n_workers=get_n_workers())
 
     rca_income_service_data.columns = [c.value for c in rca_income_service_data.columns]
     rca_income_service_robustness__screen_time_data__individual = rca_income_service_robustness__screen_time_data__individual.assign_coords(service=[s.value for s in rca_income_service_robustness__screen_time_data__individual.service.values])
@@ -85,4 +185,11 @@ if __name__ == '__main__':
     elif arg == 'nsi':
         generate_and_save_nsi_robustness_checks_data(folder_save=folder, folder_data=folder)
     elif arg == 'other':
-        generate_and_save_other_figure_data(folder_save=folder, folder_data=folder)
\ No newline at end of file
+        generate_and_save_other_figure_data(folder_save=folder, folder_data=folder)
+    elif arg == 'adaptive':
+        generate_and_save_adaptive_robustness_checks_data(folder_save=folder, folder_data=folder, target_standard_error=float(sys.argv[2]))
+    elif arg == 'aggregate_levels':
+        for city in mt.City:
+            aggregate_and_save_netmob_tile_to_levels(folder_path=folder, city=city)
+    elif arg == 'aggregate':
+        aggregate_and_save_netmob_tile_to_insee_tile_all_cities(folder_path=folder, n_workers=get_n_workers(), memory_budget_gb=get_memory_budget_gb())
\ No newline at end of file
@@ -8,7 +8,8 @@ import mobile_traffic as mt
 import insee
 import noise
 
-from mobile_data import MobileData, ScreenTimeData
+from mobile_data import MobileData, ScreenTimeData, ACCUMULATION_DTYPE, densify
+from tile_registry import insee_tile_registry
 
 
 def night_screen_index_insee_tile(screen_time_data: ScreenTimeData) -> pd.DataFrame:
@@ -29,13 +30,14 @@ def _night_screen_index(screen_time_data: ScreenTimeData, sum_over: str) -> pd.D
         night_screen_index_city = _night_screen_index_city(screen_time_data=screen_time_data_city, sum_over=sum_over)
         night_screen_index_city['city'] = city.value
         night_screen_index.append(night_screen_index_city)
+        del screen_time_data_city
 
     night_screen_index = pd.concat(night_screen_index)
     return night_screen_index
 
 
 def _night_screen_index_city(screen_time_data: xr.DataArray, sum_over: str):
-    screen_time_data_x_by_time = screen_time_data.sum(dim=sum_over)
+    screen_time_data_x_by_time = densify(data=screen_time_data.sum(dim=sum_over, dtype=ACCUMULATION_DTYPE))
     total_screen_time_x = screen_time_data_x_by_time.sum(dim='time')
     screen_time_probability_x_by_time = (screen_time_data_x_by_time / total_screen_time_x).to_pandas()
     difference = _compute_difference_between_cumulative_distribution_and_mean_of_cumulative_distributions(probability_distributions=screen_time_probability_x_by_time)
@@ -59,12 +61,44 @@ def log2_mean_income_insee_tile(insee_tiles: List[str]) -> pd.DataFrame:
 
 
 def map_insee_tile_to_income_category(insee_tiles: List[str], income_quantiles: List[float]) -> Dict[str, str]:
+    income_categories = income_category_insee_tile(insee_tiles=insee_tiles, income_quantiles=income_quantiles)
+    map_insee_tile_to_income_category = income_categories.to_dict()
+    return map_insee_tile_to_income_category
+
+
+def income_category_insee_tile(insee_tiles: List[str], income_quantiles: List[float]) -> pd.Series:
     log2_income = log2_mean_income_insee_tile(insee_tiles=insee_tiles)
     log2_income_quantiles = np.quantile(log2_income['log2_income'], q=income_quantiles)
     bins = [-np.inf] + log2_income_quantiles.tolist() + [np.inf]
     income_categories = pd.cut(log2_income['log2_income'], bins=bins, labels=[f'q{k}' for k in range(len(bins) - 1)])
-    map_insee_tile_to_income_category = income_categories.to_dict()
-    return map_insee_tile_to_income_category
+    return income_categories.astype(object)
+
+
+# log2 income of every insee tile registry code, in code order. NaN marks tiles without income data
+_log2_income_insee_tile_codes = np.array([], dtype=np.float64)
+
+
+def log2_mean_income_insee_tile_codes(insee_tile_codes: np.ndarray) -> np.ndarray:
+    # Only codes registered since the last call are looked up by tile id, afterwards the income is read by code
+    global _log2_income_insee_tile_codes
+    n_cached = len(_log2_income_insee_tile_codes)
+    if len(insee_tile_registry) > n_cached:
+        new_insee_tiles = insee_tile_registry.decode(codes=np.arange(n_cached, len(insee_tile_registry)))
+        log2_income = log2_mean_income_insee_tile(insee_tiles=list(new_insee_tiles))['log2_income']
+        log2_income = log2_income.loc[~log2_income.index.duplicated()].reindex(new_insee_tiles).values.astype(np.float64)
+        _log2_income_insee_tile_codes = np.concatenate([_log2_income_insee_tile_codes, log2_income])
+    return _log2_income_insee_tile_codes[np.asarray(insee_tile_codes, dtype=np.int32)]
+
+
+def income_category_insee_tile_codes(insee_tile_codes: np.ndarray, income_quantiles: List[float]) -> np.ndarray:
+    # Same categories as income_category_insee_tile: quantiles over the distinct tiles, bins closed on the right
+    log2_income = log2_mean_income_insee_tile_codes(insee_tile_codes=insee_tile_codes)
+    log2_income_distinct_tiles = log2_mean_income_insee_tile_codes(insee_tile_codes=np.unique(insee_tile_codes))
+    log2_income_quantiles = np.quantile(log2_income_distinct_tiles[~np.isnan(log2_income_distinct_tiles)], q=income_quantiles)
+    labels = np.array([f'q{k}' for k in range(len(log2_income_quantiles) + 1)], dtype=object)
+    income_categories = labels[np.searchsorted(log2_income_quantiles, log2_income, side='left')]
+    income_categories[np.isnan(log2_income)] = np.nan
+    return income_categories
 
 
 def get_frequently_visited_amenities():
@@ -162,7 +196,7 @@ def noise_levels_insee_tile(insee_tiles: List[str]):
 
 def log10_service_consumption(mobile_data: MobileData) -> pd.DataFrame:
     stacked_data = mobile_data.stack_data_along_insee_tile_axis()
-    service_consumption = stacked_data.sum(dim='time').sum(dim='insee_tile').to_pandas()
+    service_consumption = densify(data=stacked_data.sum(dim='time', dtype=ACCUMULATION_DTYPE)).sum(dim='insee_tile').to_pandas()
     service_consumption = np.log10(1 + service_consumption)
     service_consumption = service_consumption.to_frame(name='log10_service_consumption')
     return service_consumption
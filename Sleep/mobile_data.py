@@ -1,17 +1,67 @@
-from typing import List, Dict, Callable
+import os
+import json
+import shutil
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from collections.abc import Mapping
+from typing import List, Dict, Callable, Iterator
 
 import numpy as np
 import xarray as xr
-from datetime import time, datetime,timedelta
+from datetime import time, datetime
 
 import mobile_traffic as mt
 
+import time_axis
+from tile_registry import insee_tile_registry
+
+
+# Compact storage keeps traffic in float32 and screen-time minutes in the smallest unsigned integer type that fits.
+# Reductions accumulate in float64, which keeps NSI and RCA within COMPACT_RELATIVE_TOLERANCE of the float64 results.
+COMPACT_TRAFFIC_DTYPE = np.float32
+COMPACT_INTEGER_DTYPES = [np.uint16, np.uint32]
+ACCUMULATION_DTYPE = np.float64
+COMPACT_RELATIVE_TOLERANCE = 1e-5
+
+# Version 2 stores hold the time axis as integer minutes from the night reference time, version 3 stores also record
+# the size and modification time of the files they were built from
+STORE_FORMAT_VERSION = 3
+
+
+def compact_integer_dtype(max_value: int) -> type:
+    for dtype in COMPACT_INTEGER_DTYPES:
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def is_compact_dtype(dtype: np.dtype) -> bool:
+    return np.dtype(dtype) in [np.dtype(COMPACT_TRAFFIC_DTYPE)] + [np.dtype(d) for d in COMPACT_INTEGER_DTYPES]
+
+
+def densify(data: xr.DataArray) -> xr.DataArray:
+    if hasattr(data.data, 'todense'):
+        return data.copy(data=data.data.todense())
+    return data
+
 
 class MobileData:
     _dataset_path = '/Users/andrea/Desktop/PhD/Projects/Current/NetMob/Data/MobileTrafficData'
+    # One chunk per service keeps selections by service cheap and lets reductions stream through the cube
+    _default_chunks = {'service': 1}
 
     def __init__(self, data: Dict[mt.City, xr.DataArray]):
         self.data = data
+        self._stacked = None
+        self._offsets = None
+        self._insee_tile_codes = {}
+
+    @classmethod
+    def from_stacked(cls, stacked: xr.DataArray, offsets: Dict[mt.City, slice]):
+        mobile_data = cls(data={c: stacked.isel(insee_tile=o) for c, o in offsets.items()})
+        mobile_data._stacked = stacked
+        mobile_data._offsets = offsets
+        return mobile_data
 
     @staticmethod
     def _get_dataset_file_path(synthetic: bool, insee_tiles: bool, folder_path: str = None):
@@ -23,50 +73,271 @@ class MobileData:
             return f'{folder_path}/mobile_traffic_{{city}}_by_{tile_name}_service_and_time.nc'
 
     @classmethod
-    def load_dataset(cls, synthetic: bool = False, insee_tiles: bool = True, folder_path: str = None):
-        data = {}
+    def get_dataset_file_paths(cls, synthetic: bool = False, insee_tiles: bool = True, folder_path: str = None, city: List[mt.City] = None) -> List[str]:
         file_path = cls._get_dataset_file_path(synthetic=synthetic, insee_tiles=insee_tiles, folder_path=folder_path)
-        for c in mt.City:
-            data_city = xr.open_dataset(file_path.format(city=c.value.lower())).to_array().squeeze()
-            data_city = data_city.assign_coords(time=[datetime.strptime(t, '%H:%M:%S').time() for t in data_city.time.values])
-            sorted_times = cls._sort_time_index(time_index=data_city.time.values, reference_time=time(22))
-            data_city = data_city.reindex(time=sorted_times)
-            data[c] = data_city
+        cities = list(mt.City) if city is None else city
+        return [file_path.format(city=c.value.lower()) for c in cities]
+
+    @classmethod
+    def load_dataset(cls, synthetic: bool = False, insee_tiles: bool = True, folder_path: str = None, lazy: bool = False, chunks: Dict[str, int] = None, service: List[mt.Service] = None, city: List[mt.City] = None, n_workers: int = 1, reference_time: time = time_axis.NIGHT_REFERENCE_TIME):
+        chunks = (cls._default_chunks if chunks is None else chunks) if lazy else None
+        cities = list(mt.City) if city is None else city
+        file_paths = cls.get_dataset_file_paths(synthetic=synthetic, insee_tiles=insee_tiles, folder_path=folder_path, city=cities)
+        load_dataset_city = partial(cls._load_dataset_city, chunks=chunks, service=service, reference_time=reference_time)
+        if n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                data = dict(zip(cities, executor.map(load_dataset_city, file_paths)))
+        else:
+            data = dict(zip(cities, map(load_dataset_city, file_paths)))
 
         return MobileData(data=data)
 
+    @classmethod
+    def _load_dataset_city(cls, file_path: str, chunks: Dict[str, int] = None, service: List[mt.Service] = None, reference_time: time = time_axis.NIGHT_REFERENCE_TIME) -> xr.DataArray:
+        dataset_city = xr.open_dataset(file_path, chunks=chunks)
+        if service is not None:
+            dataset_city = dataset_city.sel(service=[s.value for s in service])
+        data_city = dataset_city.to_array().squeeze(dim='variable')
+        data_city = data_city.assign_coords(time=time_axis.labels_to_minutes(labels=data_city.time.values, reference_time=reference_time))
+        data_city = data_city.sortby('time')
+        return data_city
+
+    def to_store(self, store_path: str, source_file_paths: List[str] = None):
+        # The store is written next to its final location and moved in place once complete, so an interrupted or
+        # concurrent job never leaves a partial store behind. The size and modification time of the source files are
+        # recorded so that the store can be rejected once a source is rewritten or patched
+        tmp_path = f'{store_path}.tmp-{os.getpid()}'
+        for c, d in self.data.items():
+            city_path = os.path.join(tmp_path, c.value.lower())
+            os.makedirs(city_path, exist_ok=True)
+            np.save(os.path.join(city_path, 'data.npy'), np.asarray(d.values))
+            for dim in d.dims:
+                coord = d[dim].values
+                if coord.dtype == object:
+                    coord = coord.astype(str)
+                np.save(os.path.join(city_path, f'coord_{dim}.npy'), coord)
+            with open(os.path.join(city_path, 'dims.json'), 'w') as f:
+                json.dump(list(d.dims), f)
+        with open(os.path.join(tmp_path, 'metadata.json'), 'w') as f:
+            sources = _source_file_signatures(file_paths=[] if source_file_paths is None else source_file_paths)
+            json.dump({'format_version': STORE_FORMAT_VERSION, 'services': [str(s) for s in self.services()], 'cities': [c.value for c in self.cities()], 'sources': sources}, f)
+
+        if os.path.isdir(store_path):
+            stale_path = f'{store_path}.stale-{os.getpid()}'
+            os.replace(store_path, stale_path)
+            os.replace(tmp_path, store_path)
+            shutil.rmtree(stale_path)
+        else:
+            os.replace(tmp_path, store_path)
+
+    @staticmethod
+    def read_store_metadata(store_path: str) -> Dict:
+        metadata_path = os.path.join(store_path, 'metadata.json')
+        if not os.path.isfile(metadata_path):
+            raise ValueError(f'{store_path} is not a complete store, it has no metadata')
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        if metadata.get('format_version') != STORE_FORMAT_VERSION:
+            raise ValueError(f'{store_path} has store format {metadata.get("format_version")}, expected {STORE_FORMAT_VERSION}')
+        return metadata
+
+    @staticmethod
+    def is_store_valid(store_path: str, service: List[mt.Service] = None, source_file_paths: List[str] = None) -> bool:
+        try:
+            metadata = MobileData.read_store_metadata(store_path=store_path)
+            sources = None if source_file_paths is None else _source_file_signatures(file_paths=source_file_paths)
+        except (ValueError, OSError):
+            return False
+        if sources is not None and metadata['sources'] != sources:
+            return False
+        return service is None or metadata['services'] == [s.value for s in service]
+
+    @classmethod
+    def from_store(cls, store_path: str, service: List[mt.Service] = None, city: List[mt.City] = None, mmap: bool = True):
+        metadata = cls.read_store_metadata(store_path=store_path)
+        missing_services = [] if service is None else [s.value for s in service if s.value not in metadata['services']]
+        missing_cities = [] if city is None else [c.value for c in city if c.value not in metadata['cities']]
+        if missing_services or missing_cities:
+            raise ValueError(f'{store_path} does not contain services {missing_services} or cities {missing_cities}')
+
+        data = {}
+        cities = [mt.City(c) for c in metadata['cities']] if city is None else city
+        for c in cities:
+            data[c] = cls._load_store_city(city_path=os.path.join(store_path, c.value.lower()), service=service, mmap=mmap)
+
+        return MobileData(data=data)
+
+    @staticmethod
+    def _load_store_city(city_path: str, service: List[mt.Service] = None, mmap: bool = True) -> xr.DataArray:
+        with open(os.path.join(city_path, 'dims.json')) as f:
+            dims = json.load(f)
+        coords = [np.load(os.path.join(city_path, f'coord_{dim}.npy')) for dim in dims]
+        data_city = np.load(os.path.join(city_path, 'data.npy'), mmap_mode='r' if mmap else None)
+        data_city = xr.DataArray(data_city, dims=dims, coords=coords)
+        if service is not None and list(data_city.service.values) != [s.value for s in service]:
+            data_city = data_city.sel(service=[s.value for s in service])
+        return data_city
+
+    @classmethod
+    def stream_dataset(cls, synthetic: bool = False, insee_tiles: bool = True, folder_path: str = None, service: List[mt.Service] = None, city: List[mt.City] = None, reference_time: time = time_axis.NIGHT_REFERENCE_TIME):
+        file_path = cls._get_dataset_file_path(synthetic=synthetic, insee_tiles=insee_tiles, folder_path=folder_path)
+        cities = list(mt.City) if city is None else city
+        data = CityDataStream(load_city=lambda c: cls._load_dataset_city(file_path=file_path.format(city=c.value.lower()), service=service, reference_time=reference_time), cities=cities)
+        return MobileData(data=data)
+
+    def is_streaming(self) -> bool:
+        return isinstance(self.data, CityDataStream)
+
+    def map_data(self, fct: Callable[[xr.DataArray], xr.DataArray]):
+        if self.is_streaming():
+            return self.data.map(fct=fct)
+        return {c: fct(d) for c, d in self.data.items()}
+
     def filter(self, service: List[mt.Service]):
         service_vals = [s.value for s in service]
-        data = {c: d.sel(service=service_vals) for c, d in self.data.items()}
+        if self.is_stacked():
+            return MobileData.from_stacked(stacked=self._stacked.sel(service=service_vals), offsets=self._offsets)
+        data = self.map_data(fct=lambda d: d.sel(service=service_vals))
         return MobileData(data=data)
 
     def cities(self):
         return list(self.data.keys())
 
+    def _metadata_array(self) -> xr.DataArray:
+        if self.is_streaming():
+            return self.data.template()
+        return next(iter(self.data.values()))
+
     def services(self):
-        return list(self.data.values())[0].service.values
+        return self._metadata_array().service.values
 
     def times(self):
-        return list(self.data.values())[0].time.values
+        return self._metadata_array().time.values
+
+    def dtype(self) -> np.dtype:
+        return self._metadata_array().dtype
+
+    def is_compact(self) -> bool:
+        return is_compact_dtype(dtype=self.dtype())
+
+    def compact(self):
+        if self.is_stacked():
+            return type(self).from_stacked(stacked=self._compact_array(data=self._stacked), offsets=self._offsets)
+        return type(self)(data=self.map_data(fct=self._compact_array))
+
+    @staticmethod
+    def _compact_array(data: xr.DataArray) -> xr.DataArray:
+        if np.issubdtype(data.dtype, np.floating):
+            return data.astype(COMPACT_TRAFFIC_DTYPE)
+        elif np.issubdtype(data.dtype, np.integer):
+            return data.astype(compact_integer_dtype(max_value=int(data.max())))
+        return data
+
+    def is_sparse(self) -> bool:
+        return hasattr(self._metadata_array().data, 'todense')
+
+    def to_sparse(self):
+        import sparse
+
+        def to_sparse_array(data: xr.DataArray) -> xr.DataArray:
+            return data.copy(data=sparse.COO.from_numpy(np.asarray(data.values)))
+
+        if self.is_stacked():
+            return type(self).from_stacked(stacked=to_sparse_array(data=self._stacked), offsets=self._offsets)
+        return type(self)(data=self.map_data(fct=to_sparse_array))
+
+    def to_dense(self):
+        if self.is_stacked():
+            return type(self).from_stacked(stacked=densify(data=self._stacked), offsets=self._offsets)
+        return type(self)(data=self.map_data(fct=densify))
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self.is_stacked():
+            # The per-city arrays are views of the stacked one, pickling them would ship the data twice
+            state['data'] = None
+        # Registry codes are only valid in the process that encoded them
+        state['_insee_tile_codes'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.data is None:
+            self.data = {c: self._stacked.isel(insee_tile=o) for c, o in self._offsets.items()}
+
+    def is_stacked(self) -> bool:
+        return self._stacked is not None and list(self.data.keys()) == list(self._offsets.keys())
+
+    def offsets(self) -> Dict[mt.City, slice]:
+        return self._offsets
+
+    def stack(self):
+        if self.is_stacked():
+            return self
+        data = dict(self.data)
+        n_tiles = np.cumsum([0] + [d.sizes['insee_tile'] for d in data.values()])
+        offsets = {c: slice(int(n_tiles[k]), int(n_tiles[k + 1])) for k, c in enumerate(data.keys())}
+        return type(self).from_stacked(stacked=xr.concat(list(data.values()), dim='insee_tile'), offsets=offsets)
+
+    def insee_tile_codes(self, city: mt.City = None) -> np.ndarray:
+        # Registry codes of the insee tiles of one city, or of all cities in stacking order, encoded once per object
+        if city not in self._insee_tile_codes:
+            if city is not None:
+                insee_tiles = self.data[city].insee_tile.values
+            elif self.is_stacked():
+                insee_tiles = self._stacked.insee_tile.values
+            else:
+                insee_tiles = np.concatenate([self.data[c].insee_tile.values for c in self.cities()])
+            self._insee_tile_codes[city] = insee_tile_registry.encode(tiles=insee_tiles)
+        return self._insee_tile_codes[city]
 
     def stack_data_along_insee_tile_axis(self) -> xr.DataArray:
+        if self.is_stacked():
+            return self._stacked
         data_stacked = xr.concat([data for city, data in self.data.items()], dim='insee_tile')
         return data_stacked
 
-    @staticmethod
-    def _sort_time_index(time_index: List[time], reference_time: time):
-        auxiliary_day = datetime(2020, 2, 1)
-        auxiliary_dates = []
 
-        for t in time_index:
-            if t < reference_time:
-                auxiliary_dates.append(datetime.combine(date=auxiliary_day + timedelta(days=1), time=t))
-            else:
-                auxiliary_dates.append(datetime.combine(date=auxiliary_day, time=t))
+def _source_file_signatures(file_paths: List[str]) -> Dict[str, List[int]]:
+    signatures = {}
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        signatures[os.path.abspath(file_path)] = [stat.st_size, stat.st_mtime_ns]
+    return signatures
+
+
+class CityDataStream(Mapping):
+    # Loads a city each time it is accessed and keeps no reference to it, so only the cities in use are resident
+    def __init__(self, load_city: Callable[[mt.City], xr.DataArray], cities: List[mt.City], transforms: List[Callable[[xr.DataArray], xr.DataArray]] = None):
+        self._load_city = load_city
+        self._cities = cities
+        self._transforms = [] if transforms is None else transforms
+        self._template = None
+
+    def __getitem__(self, city: mt.City) -> xr.DataArray:
+        if city not in self._cities:
+            raise KeyError(city)
+        data_city = self._load_city(city)
+        for transform in self._transforms:
+            data_city = transform(data_city)
+        if self._template is None:
+            # An empty copy keeps services, times and dtype without holding on to the city data
+            self._template = data_city.isel(insee_tile=slice(0, 0)).copy()
+        return data_city
+
+    def template(self) -> xr.DataArray:
+        if self._template is None:
+            self[self._cities[0]]
+        return self._template
+
+    def __iter__(self) -> Iterator[mt.City]:
+        return iter(self._cities)
+
+    def __len__(self) -> int:
+        return len(self._cities)
 
-        auxiliary_dates.sort()
-        sorted_times = [d.time() for d in auxiliary_dates]
-        return sorted_times
+    def map(self, fct: Callable[[xr.DataArray], xr.DataArray]) -> 'CityDataStream':
+        return CityDataStream(load_city=self._load_city, cities=self._cities, transforms=self._transforms + [fct])
 
 
 class TrafficData(MobileData):
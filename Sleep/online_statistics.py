@@ -0,0 +1,87 @@
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+
+class OnlineStatistics:
+    # Welford mean and variance per cell of a fixed index, NaN values are skipped cell by cell.
+    # Quantiles are estimated from a uniform reservoir of at most reservoir_size values per cell.
+    def __init__(self, quantiles: List[float] = None, reservoir_size: int = 1000, seed: int = None):
+        self.quantiles = [] if quantiles is None else list(quantiles)
+        self.reservoir_size = reservoir_size
+        self._rng = np.random.default_rng(seed)
+        self._index = None
+        self._count = None
+        self._mean = None
+        self._m2 = None
+        self._reservoir = None
+        self.n_updates = 0
+
+    def update(self, sample: pd.Series):
+        if self._index is None:
+            self._initialize(index=sample.index)
+        values = sample.reindex(self._index).values.astype(np.float64)
+        valid = ~np.isnan(values)
+
+        self._count += valid
+        delta = np.where(valid, values - self._mean, 0)
+        self._mean += np.where(valid, delta / np.maximum(self._count, 1), 0)
+        self._m2 += np.where(valid, delta * (values - self._mean), 0)
+        self.n_updates += 1
+
+        if self.quantiles:
+            self._update_reservoir(values=values, valid=valid)
+
+    def _initialize(self, index: pd.Index):
+        self._index = index
+        self._count = np.zeros(len(index), dtype=np.int64)
+        self._mean = np.zeros(len(index), dtype=np.float64)
+        self._m2 = np.zeros(len(index), dtype=np.float64)
+        if self.quantiles:
+            self._reservoir = np.full((len(index), self.reservoir_size), np.nan)
+
+    def _update_reservoir(self, values: np.ndarray, valid: np.ndarray):
+        # Algorithm R: the n-th value of a cell replaces a random slot with probability reservoir_size / n
+        slot = np.where(self._count <= self.reservoir_size, self._count - 1, self._rng.integers(0, np.maximum(self._count, 1)))
+        replace = valid & (slot < self.reservoir_size)
+        cells = np.flatnonzero(replace)
+        self._reservoir[cells, slot[cells]] = values[cells]
+
+    def n_samples(self) -> pd.Series:
+        return pd.Series(self._count, index=self._index, name='n_samples')
+
+    def mean(self) -> pd.Series:
+        return pd.Series(np.where(self._count > 0, self._mean, np.nan), index=self._index, name='mean')
+
+    def std(self) -> pd.Series:
+        variance = self._m2 / np.maximum(self._count - 1, 1)
+        return pd.Series(np.where(self._count > 1, np.sqrt(variance), np.nan), index=self._index, name='std')
+
+    def standard_error(self) -> pd.Series:
+        # A cell with fewer than two values has no precision estimate, it counts as infinitely imprecise
+        standard_error = np.where(self._count > 1, self.std().values / np.sqrt(np.maximum(self._count, 1)), np.inf)
+        return pd.Series(standard_error, index=self._index, name='standard_error')
+
+    def quantile(self, q: float) -> pd.Series:
+        if self._reservoir is None:
+            raise ValueError('Quantiles were not requested when the statistics were created')
+        with np.errstate(all='ignore'):
+            filled = ~np.isnan(self._reservoir).all(axis=1)
+            quantile = np.full(len(self._index), np.nan)
+            quantile[filled] = np.nanquantile(self._reservoir[filled], q, axis=1)
+        return pd.Series(quantile, index=self._index, name=f'q{q}')
+
+    def max_standard_error(self) -> float:
+        if self._index is None or len(self._index) == 0:
+            return np.inf
+        return float(self.standard_error().max())
+
+    def n_cells_without_precision(self) -> int:
+        return 0 if self._count is None else int((self._count < 2).sum())
+
+    def to_frame(self, precision: bool = False) -> pd.DataFrame:
+        statistics = [self.mean(), self.std()] + [self.quantile(q) for q in self.quantiles]
+        if precision:
+            statistics += [self.standard_error(), self.n_samples()]
+        return pd.concat(statistics, axis=1)
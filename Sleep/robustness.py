@@ -1,5 +1,7 @@
-from typing import Dict, List, Callable, Any, Union, Tuple
+from typing import Dict, List, Callable, Any, Union, Tuple, Iterator
 from enum import Enum
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 import xarray as xr
 import pandas as pd
@@ -9,7 +11,7 @@ import mobile_traffic as mt
 
 import engineer_features as ef
 import transform
-from mobile_data import MobileData, TrafficData, ScreenTimeData
+from mobile_data import MobileData, TrafficData, ScreenTimeData, ACCUMULATION_DTYPE, COMPACT_TRAFFIC_DTYPE, compact_integer_dtype, is_compact_dtype, densify
 
 
 class SamplingTechnique(Enum):
@@ -17,44 +19,166 @@ class SamplingTechnique(Enum):
     MEAN = 'mean'
 
 
-def rca_income_and_service_samples__screen_time(traffic_data: TrafficData, income_quantiles: List[float], n_samples: int, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]], sampling_technique: SamplingTechnique) -> xr.DataArray:
-    screen_time_data_samples = get_screen_time_data_samples(traffic_data=traffic_data, n_samples=n_samples, traffic_per_minute_sampler=traffic_per_minute_sampler, sampling_technique=sampling_technique)
-    rca_samples = _rca_income_and_service_samples(mobile_data_samples=screen_time_data_samples, income_quantiles=income_quantiles)
+def rca_income_and_service_samples__screen_time(traffic_data: TrafficData, income_quantiles: List[float], n_samples: int, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]], sampling_technique: SamplingTechnique, batched: bool = False, seed: int = None, n_workers: int = 1) -> xr.DataArray:
+    if batched:
+        screen_time_data_samples = get_screen_time_data_samples__batched(traffic_data=traffic_data, n_samples=n_samples, traffic_per_minute_sampler=traffic_per_minute_sampler, sampling_technique=sampling_technique, seed=seed)
+        return _rca_income_and_service_samples__batched(mobile_data_samples=screen_time_data_samples, income_quantiles=income_quantiles)
+    md_by_insee_tile_and_service_samples = get_screen_time_data_samples(traffic_data=traffic_data, n_samples=n_samples, traffic_per_minute_sampler=traffic_per_minute_sampler, sampling_technique=sampling_technique, seed=seed, n_workers=n_workers, reduce=reduce_to_insee_tile_and_service)
+    rca_samples = _rca_income_and_service_samples__reduced(md_by_insee_tile_and_service_samples=md_by_insee_tile_and_service_samples, income_quantiles=income_quantiles)
     return rca_samples
 
 
-def rca_income_and_service_samples__amenity(mobile_data: MobileData, thresholds_and_buffers: List[Tuple[int, float]], income_quantiles: List[float]) -> xr.DataArray:
-    amenity_data_samples = get_amenity_data_samples(mobile_data=mobile_data, thresholds_and_buffers=thresholds_and_buffers)
+def rca_income_and_service_samples__amenity(mobile_data: MobileData, thresholds_and_buffers: List[Tuple[int, float]], income_quantiles: List[float], n_workers: int = 1) -> xr.DataArray:
+    amenity_data_samples = get_amenity_data_samples(mobile_data=mobile_data, thresholds_and_buffers=thresholds_and_buffers, n_workers=n_workers)
     rca_samples = _rca_income_and_service_samples(mobile_data_samples=amenity_data_samples, income_quantiles=income_quantiles)
     return rca_samples
 
 
-def night_screen_index_samples__screen_time(traffic_data: TrafficData, n_samples: int, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]], sampling_technique: SamplingTechnique) -> pd.DataFrame:
-    screen_time_data_samples = get_screen_time_data_samples(traffic_data=traffic_data, n_samples=n_samples, traffic_per_minute_sampler=traffic_per_minute_sampler, sampling_technique=sampling_technique)
-    nsi_samples = _night_screen_index_samples(screen_time_data_samples=screen_time_data_samples)  # noqa
+def night_screen_index_samples__screen_time(traffic_data: TrafficData, n_samples: int, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]], sampling_technique: SamplingTechnique, batched: bool = False, seed: int = None, n_workers: int = 1) -> pd.DataFrame:
+    if batched:
+        screen_time_data_samples = get_screen_time_data_samples__batched(traffic_data=traffic_data, n_samples=n_samples, traffic_per_minute_sampler=traffic_per_minute_sampler, sampling_technique=sampling_technique, seed=seed)
+        return _night_screen_index_samples__batched(screen_time_data_samples=screen_time_data_samples)
+    nsi_samples = get_screen_time_data_samples(traffic_data=traffic_data, n_samples=n_samples, traffic_per_minute_sampler=traffic_per_minute_sampler, sampling_technique=sampling_technique, seed=seed, n_workers=n_workers, reduce=reduce_to_night_screen_index)
+    nsi_samples = pd.concat([nsi_sample.rename(f'night_screen_index_{sample_name}') for sample_name, nsi_sample in nsi_samples.items()], axis=1)
     return nsi_samples
 
 
-def night_screen_index_samples__amenity(screen_time_data: ScreenTimeData, thresholds_and_buffers: List[Tuple[int, float]]) -> pd.DataFrame:
-    amenity_data_samples = get_amenity_data_samples(mobile_data=screen_time_data, thresholds_and_buffers=thresholds_and_buffers)
+def night_screen_index_samples__amenity(screen_time_data: ScreenTimeData, thresholds_and_buffers: List[Tuple[int, float]], n_workers: int = 1) -> pd.DataFrame:
+    amenity_data_samples = get_amenity_data_samples(mobile_data=screen_time_data, thresholds_and_buffers=thresholds_and_buffers, n_workers=n_workers)
     nsi_samples = _night_screen_index_samples(screen_time_data_samples=amenity_data_samples)  # noqa
     return nsi_samples
 
 
-def get_amenity_data_samples(mobile_data: MobileData, thresholds_and_buffers: List[Tuple[int, float]]) -> Dict[str, MobileData]:
-    amenity_data_samples = {str((threshold, buffer_size_m)): filter_out_tiles_with_many_amenities_open_at_night(mobile_data=mobile_data, buffer_size_m=buffer_size_m, threshold=threshold) for (threshold, buffer_size_m) in thresholds_and_buffers}
+def get_amenity_data_samples(mobile_data: MobileData, thresholds_and_buffers: List[Tuple[int, float]], n_workers: int = 1) -> Dict[str, MobileData]:
+    # Workers only receive the tile ids and send back which tiles to keep, the data itself never leaves this process
+    insee_tiles = {city: mobile_data.data[city].insee_tile.values for city in mobile_data.cities()}
+    insee_tiles_to_keep = _map_samples(fct=_amenity_insee_tiles_to_keep, args=thresholds_and_buffers, state={'insee_tiles': insee_tiles}, n_workers=n_workers)
+    amenity_data_samples = {}
+    for (threshold, buffer_size_m), insee_tiles_to_keep_sample in zip(thresholds_and_buffers, insee_tiles_to_keep):
+        amenity_data_samples[str((threshold, buffer_size_m))] = MobileData(data={city: mobile_data.data[city].isel(insee_tile=insee_tiles_to_keep_sample[city]) for city in mobile_data.cities()})
     return amenity_data_samples
 
 
-def get_screen_time_data_samples(traffic_data: TrafficData, n_samples: int, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]], sampling_technique: SamplingTechnique) -> Dict[str, MobileData]:
+def get_screen_time_data_samples(traffic_data: TrafficData, n_samples: int, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]], sampling_technique: SamplingTechnique, seed: int = None, n_workers: int = 1, reduce: Callable[[ScreenTimeData], Any] = None) -> Dict[str, Any]:
+    screen_time_data_samples = iter_screen_time_data_samples(traffic_data=traffic_data, n_samples=n_samples, traffic_per_minute_sampler=traffic_per_minute_sampler, sampling_technique=sampling_technique, seed=seed, n_workers=n_workers, reduce=reduce)
+    screen_time_data_samples = {str(i): screen_time_data_sample for i, screen_time_data_sample in enumerate(screen_time_data_samples)}
+    return screen_time_data_samples
+
+
+def iter_screen_time_data_samples(traffic_data: TrafficData, n_samples: int, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]], sampling_technique: SamplingTechnique, seed: Union[int, np.random.SeedSequence] = None, n_workers: int = 1, reduce: Callable[[ScreenTimeData], Any] = None) -> Iterator[Any]:
+    # reduce runs where the sample is drawn, so that only its (much smaller) result is sent back from the workers.
+    # It must be picklable, e.g. a module-level function such as reduce_to_night_screen_index
+    if sampling_technique not in (SamplingTechnique.INDIVIDUAL, SamplingTechnique.MEAN):
+        raise ValueError(f'Unknown sampling technique {sampling_technique}')
     mobile_data_ = traffic_data.filter(service=list(traffic_per_minute_sampler.keys()))
+    # One independent stream per sample, so the samples do not depend on how they are split across workers
+    sample_seeds = (seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)).spawn(n_samples)
+    state = {'traffic_data': mobile_data_, 'traffic_per_minute_sampler': traffic_per_minute_sampler, 'sampling_technique': sampling_technique, 'reduce': reduce}
+    yield from _iter_samples(fct=_screen_time_data_sample, args=sample_seeds, state=state, n_workers=n_workers)
+
+
+def _map_samples(fct: Callable[[Any], Any], args: List[Any], state: Dict[str, Any], n_workers: int) -> List[Any]:
+    return list(_iter_samples(fct=fct, args=args, state=state, n_workers=n_workers))
+
+
+def _iter_samples(fct: Callable[[Any], Any], args: List[Any], state: Dict[str, Any], n_workers: int) -> Iterator[Any]:
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_set_sample_state, initargs=(state,)) as executor:
+            # Submit one round per worker at a time, so at most n_workers samples wait to be consumed
+            for start in range(0, len(args), n_workers):
+                yield from executor.map(fct, args[start:start + n_workers])
+        return
+    _set_sample_state(state=state)
+    try:
+        for arg in args:
+            yield fct(arg)
+    finally:
+        _set_sample_state(state=None)
+
+
+_sample_state = None
+
+
+def _set_sample_state(state: Dict[str, Any]):
+    global _sample_state
+    _sample_state = state
+
+
+def _screen_time_data_sample(sample_seed: np.random.SeedSequence) -> Any:
+    rng = np.random.default_rng(sample_seed)
+    traffic_data, traffic_per_minute_sampler = _sample_state['traffic_data'], _sample_state['traffic_per_minute_sampler']
+    if _sample_state['sampling_technique'] == SamplingTechnique.INDIVIDUAL:
+        screen_time_data = screen_time_data_sample__individual(traffic_data=traffic_data, traffic_per_minute_sampler=traffic_per_minute_sampler, rng=rng)
+    else:
+        screen_time_data = screen_time_data_sample__mean(traffic_data=traffic_data, traffic_per_minute_sampler=traffic_per_minute_sampler, rng=rng)
+    return screen_time_data if _sample_state['reduce'] is None else _sample_state['reduce'](screen_time_data)
+
+
+def _amenity_insee_tiles_to_keep(threshold_and_buffer: Tuple[int, float]) -> Dict[mt.City, np.ndarray]:
+    threshold, buffer_size_m = threshold_and_buffer
+    return {city: insee_tiles_without_many_amenities_open_at_night(insee_tiles=insee_tiles, threshold=threshold, buffer_size_m=buffer_size_m) for city, insee_tiles in _sample_state['insee_tiles'].items()}
+
+
+def reduce_to_night_screen_index(screen_time_data: ScreenTimeData) -> pd.Series:
+    return ef.night_screen_index_insee_tile(screen_time_data=screen_time_data)['night_screen_index']
+
+
+def reduce_to_insee_tile_and_service(screen_time_data: ScreenTimeData) -> pd.DataFrame:
+    return transform.mobile_data_by_insee_tile_and_service(mobile_data=screen_time_data)
+
+
+def get_screen_time_data_samples__batched(traffic_data: TrafficData, n_samples: int, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]], sampling_technique: SamplingTechnique, seed: int = None) -> ScreenTimeData:
+    # All samples live in one stacked array with a leading 'sample' dimension, so the tiles are stacked once
+    traffic_data_ = traffic_data.filter(service=list(traffic_per_minute_sampler.keys())).stack()
+    stacked_traffic_data = traffic_data_.stack_data_along_insee_tile_axis()
+    sample_names = [str(i) for i in range(n_samples)]
+    rngs = [np.random.default_rng(sample_seed) for sample_seed in np.random.SeedSequence(seed).spawn(n_samples)]
     if sampling_technique == SamplingTechnique.INDIVIDUAL:
-        screen_time_data_samples = {str(i): screen_time_data_sample__individual(traffic_data=mobile_data_, traffic_per_minute_sampler=traffic_per_minute_sampler) for i in range(n_samples)}
+        # Each city draws its own cumulative traffic from its own maximum, exactly as in get_screen_time_data_samples
+        samples = [screen_time_data_sample__individual(traffic_data=traffic_data_, traffic_per_minute_sampler=traffic_per_minute_sampler, rng=rng).stack_data_along_insee_tile_axis() for rng in rngs]
+        screen_time_data_samples = xr.concat(samples, dim=pd.Index(sample_names, name='sample'))
     elif sampling_technique == SamplingTechnique.MEAN:
-        screen_time_data_samples = {str(i): screen_time_data_sample__mean(traffic_data=mobile_data_, traffic_per_minute_sampler=traffic_per_minute_sampler) for i in range(n_samples)}
+        traffic_per_minute_levels = np.array([[traffic_per_minute_sampler[service](1, rng=rng)[0] for service in traffic_per_minute_sampler] for rng in rngs])
+        traffic_per_minute_levels = xr.DataArray(traffic_per_minute_levels, dims=['sample', 'service'], coords=[sample_names, [s.value for s in traffic_per_minute_sampler]])
+        if traffic_data_.is_compact():
+            traffic_per_minute_levels = traffic_per_minute_levels.astype(COMPACT_TRAFFIC_DTYPE)
+        screen_time_data_samples = stacked_traffic_data / traffic_per_minute_levels
     else:
         raise ValueError(f'Unknown sampling technique {sampling_technique}')
-    return screen_time_data_samples
+    screen_time_data_samples = screen_time_data_samples.transpose('sample', 'insee_tile', 'service', 'time')
+    return ScreenTimeData.from_stacked(stacked=screen_time_data_samples, offsets=traffic_data_.offsets())
+
+
+def _rca_income_and_service_samples__batched(mobile_data_samples: MobileData, income_quantiles: List[float]) -> xr.DataArray:
+    md_by_income_and_service = transform.mobile_data_by_income_service_and_time(mobile_data=mobile_data_samples, income_quantiles=income_quantiles).sum(dim='time')
+    numerator = md_by_income_and_service / md_by_income_and_service.sum(dim='service')
+    denominator = md_by_income_and_service.sum(dim='income_category') / md_by_income_and_service.sum(dim=['income_category', 'service'])
+    rca = (numerator / denominator).transpose('income_category', 'service', 'sample')
+    return rca
+
+
+def _night_screen_index_samples__batched(screen_time_data_samples: ScreenTimeData) -> pd.DataFrame:
+    stacked_screen_time_data = screen_time_data_samples.stack_data_along_insee_tile_axis()
+    screen_time_data_by_time = densify(data=stacked_screen_time_data.sum(dim='service', dtype=ACCUMULATION_DTYPE))
+    screen_time_probability_by_time = screen_time_data_by_time / screen_time_data_by_time.sum(dim='time')
+    # Same NaN semantics as the pandas cumsum in ef._night_screen_index_city: NaNs are skipped but kept in place
+    cumulative_distribution = screen_time_probability_by_time.fillna(0).cumsum(dim='time').where(screen_time_probability_by_time.notnull())
+    difference = xr.concat([cumulative_distribution.isel(insee_tile=o) - cumulative_distribution.isel(insee_tile=o).mean(dim='insee_tile') for o in screen_time_data_samples.offsets().values()], dim='insee_tile')
+    night_screen_indices = (-1 * difference.sum(dim='time')).transpose('insee_tile', 'sample').to_pandas()
+    night_screen_indices.columns = [f'night_screen_index_{sample_name}' for sample_name in night_screen_indices.columns]
+    night_screen_indices.index.name = None
+    return night_screen_indices
+
+
+def _rca_income_and_service_samples__reduced(md_by_insee_tile_and_service_samples: Dict[str, pd.DataFrame], income_quantiles: List[float]) -> xr.DataArray:
+    # The income categories are looked up once, all samples share the same tiles
+    first_sample = next(iter(md_by_insee_tile_and_service_samples.values()))
+    income_category = transform.income_category_of_insee_tiles(insee_tiles=first_sample.index, income_quantiles=income_quantiles)
+    rca = [transform.compute_rca(df=md_by_insee_tile_and_service.groupby(income_category).mean()) for md_by_insee_tile_and_service in md_by_insee_tile_and_service_samples.values()]
+    data = np.stack([r.values for r in rca], axis=-1)
+    dims = ['income_category', 'service', 'sample']
+    coords = [rca[0].index, rca[0].columns, list(md_by_insee_tile_and_service_samples.keys())]
+    return xr.DataArray(data, dims=dims, coords=coords)
 
 
 def _rca_income_and_service_samples(mobile_data_samples: Dict[str, MobileData], income_quantiles: List[float]) -> xr.DataArray:
@@ -84,16 +208,20 @@ def filter_out_tiles_with_many_amenities_open_at_night(mobile_data: MobileData,
     data = {}
     for city in mobile_data.cities():
         mobile_data_city = mobile_data.data[city]
-        insee_tiles_city = mobile_data_city.insee_tile.values
-        amenities_counts = ef.log2_amenity_counts_insee_tile(insee_tiles=insee_tiles_city, buffer_size_m=buffer_size_m, amenity_type=ef.AmenityType.OPEN_AT_NIGHT)
-        insee_tiles_with_many_amenities_open_at_night = amenities_counts[amenities_counts['log2_oan_amenity_counts'] > threshold].index
-        insee_tiles_to_keep = np.setdiff1d(insee_tiles_city, insee_tiles_with_many_amenities_open_at_night)
-        mobile_data_city = mobile_data_city.sel(insee_tile=insee_tiles_to_keep)
+        insee_tiles_to_keep = insee_tiles_without_many_amenities_open_at_night(insee_tiles=mobile_data_city.insee_tile.values, threshold=threshold, buffer_size_m=buffer_size_m)
+        mobile_data_city = mobile_data_city.isel(insee_tile=insee_tiles_to_keep)
         data[city] = mobile_data_city
 
     return MobileData(data=data)
 
 
+def insee_tiles_without_many_amenities_open_at_night(insee_tiles: np.ndarray, threshold: int, buffer_size_m: float) -> np.ndarray:
+    # The amenity counts come back keyed by tile id, so a single membership test on the ids is cheaper than encoding both sides
+    amenities_counts = ef.log2_amenity_counts_insee_tile(insee_tiles=insee_tiles, buffer_size_m=buffer_size_m, amenity_type=ef.AmenityType.OPEN_AT_NIGHT)
+    insee_tiles_with_many_amenities_open_at_night = amenities_counts[amenities_counts['log2_oan_amenity_counts'] > threshold].index
+    return ~pd.Index(insee_tiles).isin(insee_tiles_with_many_amenities_open_at_night)
+
+
 def thresholds_and_buffers_amenities():
     thresholds_and_buffers = [
         (0, 500),
@@ -108,53 +236,86 @@ def thresholds_and_buffers_amenities():
 
 
 # Screen time individual sampling
-def screen_time_data_sample__individual(traffic_data: TrafficData, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]]) -> ScreenTimeData:
-    screen_time_data = {city: city_screen_time_data_sample__individual(traffic_data=traffic_data.data[city], traffic_per_minute_sampler=traffic_per_minute_sampler) for city in traffic_data.cities()}
+def screen_time_data_sample__individual(traffic_data: TrafficData, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]], rng: np.random.Generator = None) -> ScreenTimeData:
+    screen_time_data = {}
+    for city in traffic_data.cities():
+        traffic_data_city = traffic_data.data[city]
+        screen_time_data[city] = city_screen_time_data_sample__individual(traffic_data=traffic_data_city, traffic_per_minute_sampler=traffic_per_minute_sampler, compact=is_compact_dtype(dtype=traffic_data_city.dtype), rng=rng)
     screen_time_data = ScreenTimeData(data=screen_time_data)
+    if traffic_data.is_stacked():
+        screen_time_data = screen_time_data.stack()
     return screen_time_data
 
 
-def city_screen_time_data_sample__individual(traffic_data: xr.DataArray, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]]) -> xr.DataArray:
-    screen_time_city = []
-    for service in tqdm(traffic_per_minute_sampler):
-        traffic_data_service = traffic_data.sel(service=service.value)
+def city_screen_time_data_sample__individual(traffic_data: xr.DataArray, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]], compact: bool = False, rng: np.random.Generator = None) -> xr.DataArray:
+    services = list(traffic_per_minute_sampler.keys())
+    traffic_data = densify(data=traffic_data.sel(service=[s.value for s in services]).transpose('insee_tile', 'service', 'time'))
+    traffic_values = np.asarray(traffic_data.values)
 
-        cum_sum_traffic_per_minute_sample = _get_cum_sum_of_traffic_per_minute_samples(max_traffic_data=float(traffic_data_service.max()), traffic_per_minute_sampler=traffic_per_minute_sampler[service])
+    cum_sum_traffic_per_minute_samples = []
+    for k, service in enumerate(tqdm(services)):
+        max_traffic_data = float(traffic_data.isel(service=k).max())
+        cum_sum_traffic_per_minute_samples.append(_get_cum_sum_of_traffic_per_minute_samples(max_traffic_data=max_traffic_data, traffic_per_minute_sampler=traffic_per_minute_sampler[service], rng=rng))
 
-        screen_time_service_minutes = xr.apply_ufunc(lambda x: np.searchsorted(cum_sum_traffic_per_minute_sample, x), traffic_data_service)
-        screen_time_city.append(screen_time_service_minutes)
-
-    data = np.stack([s.values for s in screen_time_city], axis=1)
+    screen_time_minutes = _searchsorted_per_service(cum_sums=cum_sum_traffic_per_minute_samples, values=traffic_values)
+    max_screen_time_minutes = max(len(c) for c in cum_sum_traffic_per_minute_samples)
+    dtype = compact_integer_dtype(max_value=max_screen_time_minutes) if compact else np.int64
     dims = ['insee_tile', 'service', 'time']
-    coords = [traffic_data.insee_tile.values, list(traffic_per_minute_sampler.keys()), traffic_data.time.values]
-    screen_time_city = xr.DataArray(data, dims=dims, coords=coords)
+    coords = [traffic_data.insee_tile.values, services, traffic_data.time.values]
+    screen_time_city = xr.DataArray(screen_time_minutes.astype(dtype), dims=dims, coords=coords)
     return screen_time_city
 
 
-def _get_cum_sum_of_traffic_per_minute_samples(max_traffic_data: float, traffic_per_minute_sampler: Callable[[int], np.ndarray]) -> np.ndarray:
-    traffic_generation_sample, sum_traffic_generation_sample = [], 0
-    n_samples = _heuristic_for_number_of_samples(max_traffic_data=max_traffic_data, traffic_per_minute_sampler=traffic_per_minute_sampler)
-    while sum_traffic_generation_sample < 1.2 * max_traffic_data:
-        traffic_generation_sample += list(traffic_per_minute_sampler(n_samples))
-        sum_traffic_generation_sample = np.sum(traffic_generation_sample)
-    cum_sum_traffic_consumption_sample = np.cumsum(traffic_generation_sample)
-    return cum_sum_traffic_consumption_sample
+def _searchsorted_per_service(cum_sums: List[np.ndarray], values: np.ndarray) -> np.ndarray:
+    # Shift each service's cumulative sum past the end of the previous one, so that a single searchsorted
+    # over the concatenation answers the queries of all services at once
+    lengths = np.array([len(c) for c in cum_sums], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    shifts, running_total = np.zeros(len(cum_sums)), 0.0
+    for k, cum_sum in enumerate(cum_sums):
+        shifts[k] = running_total
+        running_total += (cum_sum[-1] if len(cum_sum) > 0 else 0.0) + 1
+    concatenated_cum_sums = np.concatenate([cum_sum + shift for cum_sum, shift in zip(cum_sums, shifts)])
+
+    service_axis = (1, -1, 1)
+    positions = np.searchsorted(concatenated_cum_sums, values + shifts.reshape(service_axis)) - starts.reshape(service_axis)
+    return np.minimum(positions, lengths.reshape(service_axis))
 
 
-def _heuristic_for_number_of_samples(max_traffic_data: float, traffic_per_minute_sampler: Callable[[int], np.ndarray]) -> int:
-    traffic_generation_samples = traffic_per_minute_sampler(10 ** 4)
+def _get_cum_sum_of_traffic_per_minute_samples(max_traffic_data: float, traffic_per_minute_sampler: Callable[[int], np.ndarray], rng: np.random.Generator = None) -> np.ndarray:
+    block_size = _heuristic_for_number_of_samples(max_traffic_data=max_traffic_data, traffic_per_minute_sampler=traffic_per_minute_sampler, rng=rng)
+    cum_sum_traffic_generation_sample = np.empty(block_size, dtype=np.float64)
+    n_filled, sum_traffic_generation_sample = 0, 0.0
+    while sum_traffic_generation_sample < 1.2 * max_traffic_data:
+        if n_filled + block_size > len(cum_sum_traffic_generation_sample):
+            buffer = np.empty(max(2 * len(cum_sum_traffic_generation_sample), n_filled + block_size), dtype=np.float64)
+            buffer[:n_filled] = cum_sum_traffic_generation_sample[:n_filled]
+            cum_sum_traffic_generation_sample = buffer
+        block = np.cumsum(traffic_per_minute_sampler(block_size, rng=rng)) + sum_traffic_generation_sample
+        cum_sum_traffic_generation_sample[n_filled:n_filled + block_size] = block
+        n_filled += block_size
+        sum_traffic_generation_sample = block[-1]
+    return cum_sum_traffic_generation_sample[:n_filled]
+
+
+def _heuristic_for_number_of_samples(max_traffic_data: float, traffic_per_minute_sampler: Callable[[int], np.ndarray], rng: np.random.Generator = None) -> int:
+    traffic_generation_samples = traffic_per_minute_sampler(10 ** 4, rng=rng)
     mean_traffic_generation_sample = np.mean(traffic_generation_samples)
-    n_samples = int(0.5 * max_traffic_data / mean_traffic_generation_sample)
+    n_samples = max(int(0.5 * max_traffic_data / mean_traffic_generation_sample), 1)
     return n_samples
 
 
 # Screen time mean sampling
 
 
-def screen_time_data_sample__mean(traffic_data: TrafficData, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]]) -> ScreenTimeData:
-    traffic_per_minute_level = np.array([traffic_per_minute_sampler[service](1) for service in traffic_per_minute_sampler]).flatten()
+def screen_time_data_sample__mean(traffic_data: TrafficData, traffic_per_minute_sampler: Dict[mt.Service, Callable[[int], np.ndarray]], rng: np.random.Generator = None) -> ScreenTimeData:
+    traffic_per_minute_level = np.array([traffic_per_minute_sampler[service](1, rng=rng) for service in traffic_per_minute_sampler]).flatten()
     traffic_per_minute_level = xr.DataArray(traffic_per_minute_level, dims=['service'], coords=[[s.value for s in traffic_per_minute_sampler]])
-    screen_time_data = {city: traffic_data.data[city] / traffic_per_minute_level for city in traffic_data.cities()}
+    if traffic_data.is_compact():
+        traffic_per_minute_level = traffic_per_minute_level.astype(COMPACT_TRAFFIC_DTYPE)
+    if traffic_data.is_stacked():
+        return ScreenTimeData.from_stacked(stacked=traffic_data.stack_data_along_insee_tile_axis() / traffic_per_minute_level, offsets=traffic_data.offsets())
+    screen_time_data = traffic_data.map_data(fct=lambda d: d / traffic_per_minute_level)
     screen_time_data = ScreenTimeData(data=screen_time_data)
     return screen_time_data
 
@@ -162,12 +323,15 @@ def screen_time_data_sample__mean(traffic_data: TrafficData, traffic_per_minute_
 # Samplers
 
 def get_normal_distribution_sampler(mean: float, std: float) -> Callable[[int], np.ndarray]:
-    def normal_distribution_sampler(n_samples: int) -> np.ndarray:
-        sample = np.random.normal(loc=mean, scale=std, size=n_samples)
-        sample = np.maximum(sample, 0.001)
-        return sample
+    # A partial of a module-level function, so that the sampler can be shipped to worker processes
+    return partial(normal_distribution_sampler, mean=mean, std=std)
+
 
-    return normal_distribution_sampler
+def normal_distribution_sampler(n_samples: int, mean: float, std: float, rng: np.random.Generator = None) -> np.ndarray:
+    rng = np.random if rng is None else rng
+    sample = rng.normal(loc=mean, scale=std, size=n_samples)
+    sample = np.maximum(sample, 0.001)
+    return sample
 
 
 def service_traffic_per_minute_sampler() -> Dict[mt.Service, Callable[[int], np.ndarray]]:
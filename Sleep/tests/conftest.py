@@ -0,0 +1,29 @@
+import os
+import sys
+
+import numpy as np
+import xarray as xr
+import pytest
+
+# The Sleep modules import each other by name, as when they are run from this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mobile_traffic as mt  # noqa: E402
+from mobile_data import TrafficData  # noqa: E402
+
+
+SERVICES = [mt.Service.YOUTUBE, mt.Service.NETFLIX]
+
+
+@pytest.fixture
+def make_traffic_data():
+    # Three tiles per city for the first two cities, two services and four quarter hours. With city_scale, city k has
+    # traffic up to 100 * city_scale ** k
+    def make_traffic_data(city_scale: float = 1) -> TrafficData:
+        rng = np.random.default_rng(0)
+        data = {}
+        for k, city in enumerate(list(mt.City)[:2]):
+            values = rng.uniform(0, 100 * city_scale ** k, size=(3, len(SERVICES), 4))
+            data[city] = xr.DataArray(values, dims=['insee_tile', 'service', 'time'], coords=[[f'{city.value}_{i}' for i in range(3)], [s.value for s in SERVICES], np.arange(4) * 15])
+        return TrafficData(data=data)
+    return make_traffic_data
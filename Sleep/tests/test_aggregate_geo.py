@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import geopandas as gpd
+import shapely
+import pytest
+
+import mobile_traffic as mt
+import aggregate_geo
+
+
+# Two netmob tiles of 100m x 100m, each split evenly between two insee tiles
+MATCHING_NETMOB_TILE_TO_INSEE_TILE = pd.DataFrame({
+    'netmob_tile': ['n0', 'n0', 'n1', 'n1'],
+    'insee_tile': ['i0', 'i1', 'i1', 'i2'],
+    'intersection_area': [5000.0, 5000.0, 5000.0, 5000.0],
+})
+INSEE_TILE_AREA = pd.Series({'i0': 5000.0, 'i1': 10000.0, 'i2': 5000.0})
+
+
+@pytest.fixture
+def city_matching(monkeypatch):
+    monkeypatch.setattr(aggregate_geo, 'get_matching_netmob_tile_to_insee_tile', lambda city_netmob_tile: MATCHING_NETMOB_TILE_TO_INSEE_TILE)
+    monkeypatch.setattr(aggregate_geo, 'get_insee_tile_area_netmob_tile_to_insee_tile', lambda city_netmob_tile: INSEE_TILE_AREA)
+
+
+def test_covered_area_only_counts_netmob_tiles_present_in_the_data(city_matching):
+    _, insee_tiles = aggregate_geo.get_covered_weights_netmob_tile_to_insee_tile(city_netmob_tile=mt.City.PARIS, netmob_tiles=pd.Index(['n0', 'n1']))
+    assert list(insee_tiles) == ['i0', 'i1', 'i2']
+
+    # Without n1, i1 is only half covered and i2 is not covered at all
+    weights, insee_tiles = aggregate_geo.get_covered_weights_netmob_tile_to_insee_tile(city_netmob_tile=mt.City.PARIS, netmob_tiles=pd.Index(['n0']))
+    assert list(insee_tiles) == ['i0']
+    np.testing.assert_allclose(weights.toarray(), [[0.5]])
+
+
+def _traffic(netmob_tiles):
+    values = np.arange(len(netmob_tiles) * 2 * 3, dtype=np.float64).reshape(len(netmob_tiles), 2, 3) + 1
+    return xr.DataArray(values, dims=['tile_id', 'service', 'time'], coords=[netmob_tiles, ['a', 'b'], [0, 15, 30]])
+
+
+def _hierarchy():
+    hierarchy = aggregate_geo.GeoHierarchy()
+    hierarchy.add_matching(matching=MATCHING_NETMOB_TILE_TO_INSEE_TILE, source='netmob_tile', target='insee_tile')
+    matching_insee_tile_to_commune = pd.DataFrame({'insee_tile': ['i0', 'i1', 'i2'], 'insee_com': ['c0', 'c0', 'c1'], 'intersection_area': INSEE_TILE_AREA.values})
+    hierarchy.add_matching(matching=matching_insee_tile_to_commune, source='insee_tile', target='insee_com', source_area=INSEE_TILE_AREA)
+    return hierarchy
+
+
+def test_build_weights_and_aggregate_with_weights_conserve_traffic():
+    traffic = _traffic(netmob_tiles=['n0', 'n1'])
+    weights, insee_tiles, covered_area = aggregate_geo.build_weights(matching=MATCHING_NETMOB_TILE_TO_INSEE_TILE, source_tiles=pd.Index(['n0', 'n1']), source_name='netmob_tile', target_name='insee_tile')
+    aggregated = aggregate_geo.aggregate_with_weights(data=traffic, weights=weights, target_tiles=insee_tiles, source_dim='tile_id', target_dim='insee_tile')
+    np.testing.assert_allclose(covered_area, [5000, 10000, 5000])
+    np.testing.assert_allclose(aggregated.sel(insee_tile='i1').values, 0.5 * (traffic.sel(tile_id='n0') + traffic.sel(tile_id='n1')).values)
+    np.testing.assert_allclose(aggregated.sum('insee_tile').values, traffic.sum('tile_id').values)
+
+
+def test_hierarchy_composes_operators_through_intermediate_levels():
+    hierarchy = _hierarchy()
+    traffic = _traffic(netmob_tiles=['n0', 'n1'])
+    by_insee_tile = hierarchy.aggregate(data=traffic, source='netmob_tile', target='insee_tile')
+    by_commune_direct = hierarchy.aggregate(data=by_insee_tile.rename({'insee_tile': 'tile_id'}), source='insee_tile', target='insee_com')
+    by_commune_composed = hierarchy.aggregate(data=traffic, source='netmob_tile', target='insee_com')
+    xr.testing.assert_allclose(by_commune_composed, by_commune_direct)
+    np.testing.assert_allclose(hierarchy.covered_area(source='netmob_tile', target='insee_com').values, [15000, 5000])
+
+
+def test_hierarchy_does_not_count_missing_source_tiles_as_zero():
+    hierarchy = _hierarchy()
+    traffic = _traffic(netmob_tiles=['n0'])
+    by_insee_tile = hierarchy.aggregate(data=traffic, source='netmob_tile', target='insee_tile')
+    assert not by_insee_tile.sel(insee_tile='i0').isnull().any()
+    assert by_insee_tile.sel(insee_tile=['i1', 'i2']).isnull().all()
+
+    partial = hierarchy.aggregate(data=traffic, source='netmob_tile', target='insee_tile', partial=True)
+    np.testing.assert_allclose(partial.sel(insee_tile='i1').values, 0.5 * traffic.sel(tile_id='n0').values)
+    covered_area = hierarchy.covered_area(source='netmob_tile', target='insee_tile', present_tiles=pd.Index(['n0']))
+    np.testing.assert_allclose(covered_area.values, [5000, 5000, 0])
+
+
+def test_matching_without_source_tiles_is_empty():
+    target_geo = gpd.GeoDataFrame(geometry=[shapely.box(0, 0, 100, 100)], index=pd.Index(['i0']), crs='EPSG:2154')
+    source_geo = target_geo.iloc[:0]
+    matching = aggregate_geo.get_matching(source_geo=source_geo, target_geo=target_geo, source_name='netmob_tile', target_name='insee_tile')
+    assert list(matching.columns) == ['netmob_tile', 'insee_tile', 'intersection_area']
+    assert len(matching) == 0
+
+
+def _grid(n_tiles_side, tile_size, name, offset=0.0):
+    geometry = [shapely.box(offset + x * tile_size, offset + y * tile_size, offset + (x + 1) * tile_size, offset + (y + 1) * tile_size) for y in range(n_tiles_side) for x in range(n_tiles_side)]
+    return gpd.GeoDataFrame(geometry=geometry, index=pd.Index([f'{name}{k}' for k in range(len(geometry))]), crs='EPSG:2154')
+
+
+def test_matching_matches_overlay_and_does_not_depend_on_chunks_or_workers():
+    # 100m source tiles against 150m target tiles shifted by 30m, so most source tiles straddle several targets
+    source_geo, target_geo = _grid(n_tiles_side=6, tile_size=100, name='n'), _grid(n_tiles_side=5, tile_size=150, name='i', offset=-30)
+    matching = aggregate_geo.get_matching(source_geo=source_geo, target_geo=target_geo, source_name='netmob_tile', target_name='insee_tile')
+
+    overlay = gpd.overlay(source_geo.rename_axis('netmob_tile').reset_index(), target_geo.rename_axis('insee_tile').reset_index(), how='intersection', keep_geom_type=True)
+    overlay = overlay.assign(intersection_area=overlay.area).loc[lambda df: df['intersection_area'] > 0]
+    expected = overlay.set_index(['netmob_tile', 'insee_tile'])['intersection_area'].sort_index()
+    actual = matching.set_index(['netmob_tile', 'insee_tile'])['intersection_area'].sort_index()
+    assert list(actual.index) == list(expected.index)
+    np.testing.assert_allclose(actual.values, expected.values)
+
+    chunked = aggregate_geo.get_matching(source_geo=source_geo, target_geo=target_geo, source_name='netmob_tile', target_name='insee_tile', n_workers=2, chunk_size=7)
+    sort = lambda df: df.sort_values(['netmob_tile', 'insee_tile']).reset_index(drop=True)
+    pd.testing.assert_frame_equal(sort(chunked), sort(matching))
+
+
+def test_perform_aggregation_weighted_and_plain_aggregations():
+    data = pd.DataFrame({
+        'insee_tile': ['g2', 'g1', 'g1', None],
+        'intersection_area': [2500.0, 5000.0, 10000.0, 100.0],
+        'a': [8.0, 2.0, 4.0, 100.0],
+        'b': [40.0, 10.0, 20.0, 100.0],
+        'c': [3.0, 1.0, 7.0, 100.0],
+    })
+    aggregated = aggregate_geo.perform_aggregation(data=data, variables=['a', 'b', 'c'], aggregation_fct={'a': 'weighted_sum', 'b': 'weighted_mean', 'c': 'max'}, group_by_var='insee_tile')
+    assert list(aggregated.index) == ['g1', 'g2']
+    assert list(aggregated.columns) == ['a', 'b', 'c', 'covered_area']
+    # weighted_sum scales by the share of a 100m x 100m tile, weighted_mean by the covered area of the group
+    np.testing.assert_allclose(aggregated['a'], [2 * 0.5 + 4 * 1.0, 8 * 0.25])
+    np.testing.assert_allclose(aggregated['b'], [(10 * 5000 + 20 * 10000) / 15000, 40.0])
+    np.testing.assert_allclose(aggregated['c'], [7.0, 3.0])
+    np.testing.assert_allclose(aggregated['covered_area'], [15000.0, 2500.0])
+
+    weighted_sum = aggregate_geo.perform_aggregation(data=data, variables=['a', 'b'], aggregation_fct='weighted_sum', group_by_var='insee_tile')
+    np.testing.assert_allclose(weighted_sum['b'], [10 * 0.5 + 20 * 1.0, 40 * 0.25])
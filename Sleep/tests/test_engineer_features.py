@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+import engineer_features as ef
+from tile_registry import insee_tile_registry
+
+
+def _fake_log2_income(lookups):
+    def log2_mean_income_insee_tile(insee_tiles):
+        lookups.append(list(insee_tiles))
+        # Tiles named '..._nan' have no income data and are left out, like tiles missing from the INSEE data
+        insee_tiles = [t for t in insee_tiles if not t.endswith('_nan')]
+        return pd.DataFrame({'log2_income': [float(sum(map(ord, t)) % 97) for t in insee_tiles]}, index=pd.Index(insee_tiles))
+    return log2_mean_income_insee_tile
+
+
+def test_income_category_by_code_matches_string_lookup_and_looks_up_each_code_once(monkeypatch):
+    lookups = []
+    monkeypatch.setattr(ef, 'log2_mean_income_insee_tile', _fake_log2_income(lookups=lookups))
+    monkeypatch.setattr(ef, '_log2_income_insee_tile_codes', np.array([], dtype=np.float64))
+
+    insee_tiles = [f'income_tile_{i}' for i in range(40)] + ['income_tile_nan']
+    insee_tile_codes = insee_tile_registry.encode(tiles=insee_tiles)
+    income_categories = ef.income_category_insee_tile_codes(insee_tile_codes=insee_tile_codes, income_quantiles=[0.25, 0.5, 0.75])
+
+    expected = ef.income_category_insee_tile(insee_tiles=insee_tiles, income_quantiles=[0.25, 0.5, 0.75]).reindex(insee_tiles)
+    assert list(income_categories[:-1]) == list(expected.values[:-1])
+    assert pd.isna(income_categories[-1])
+
+    # A second grouping on a subset reads the income by code, without another lookup by tile id
+    n_lookups = len(lookups)
+    ef.income_category_insee_tile_codes(insee_tile_codes=insee_tile_codes[::2], income_quantiles=[0.5])
+    assert len(lookups) == n_lookups
@@ -0,0 +1,164 @@
+import json
+import os
+import pickle
+
+import numpy as np
+import xarray as xr
+import pytest
+
+import mobile_traffic as mt
+from mobile_data import MobileData, TrafficData, CityDataStream, STORE_FORMAT_VERSION
+from tile_registry import insee_tile_registry
+
+
+SERVICES = [mt.Service.YOUTUBE, mt.Service.NETFLIX]
+
+
+def test_store_round_trip(tmp_path, make_traffic_data):
+    store_path = str(tmp_path / 'store')
+    traffic_data = make_traffic_data()
+    traffic_data.to_store(store_path=store_path)
+
+    loaded = MobileData.from_store(store_path=store_path, service=SERVICES[:1])
+    assert loaded.cities() == traffic_data.cities()
+    for city in traffic_data.cities():
+        xr.testing.assert_equal(loaded.data[city].load(), traffic_data.data[city].sel(service=[SERVICES[0].value]))
+    assert not any(name.startswith('store.') for name in os.listdir(tmp_path))
+
+
+def test_store_overwrite_replaces_previous_store(tmp_path, make_traffic_data):
+    store_path = str(tmp_path / 'store')
+    make_traffic_data().to_store(store_path=store_path)
+    traffic_data = make_traffic_data().filter(service=SERVICES[1:])
+    traffic_data.to_store(store_path=store_path)
+    assert MobileData.is_store_valid(store_path=store_path, service=SERVICES[1:])
+    assert os.listdir(tmp_path) == ['store']
+
+
+def test_store_is_rejected_once_a_source_file_changes(tmp_path, make_traffic_data):
+    store_path = str(tmp_path / 'store')
+    source_file_paths = [str(tmp_path / f'source_{k}.nc') for k in range(2)]
+    for source_file_path in source_file_paths:
+        with open(source_file_path, 'wb') as f:
+            f.write(b'netcdf')
+    make_traffic_data().to_store(store_path=store_path, source_file_paths=source_file_paths)
+    assert MobileData.is_store_valid(store_path=store_path, service=SERVICES, source_file_paths=source_file_paths)
+
+    # A patch in place keeps the size but moves the modification time
+    stat = os.stat(source_file_paths[1])
+    os.utime(source_file_paths[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not MobileData.is_store_valid(store_path=store_path, service=SERVICES, source_file_paths=source_file_paths)
+
+    os.remove(source_file_paths[1])
+    assert not MobileData.is_store_valid(store_path=store_path, service=SERVICES, source_file_paths=source_file_paths)
+
+
+def test_incomplete_or_outdated_store_is_rejected(tmp_path, make_traffic_data):
+    store_path = str(tmp_path / 'store')
+    make_traffic_data().to_store(store_path=store_path)
+    assert MobileData.is_store_valid(store_path=store_path, service=SERVICES)
+    assert not MobileData.is_store_valid(store_path=store_path, service=SERVICES[:1])
+
+    metadata_path = os.path.join(store_path, 'metadata.json')
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+    with open(metadata_path, 'w') as f:
+        json.dump(dict(metadata, format_version=STORE_FORMAT_VERSION - 1), f)
+    assert not MobileData.is_store_valid(store_path=store_path)
+    with pytest.raises(ValueError):
+        MobileData.from_store(store_path=store_path)
+
+    os.remove(metadata_path)
+    with pytest.raises(ValueError):
+        MobileData.from_store(store_path=store_path)
+
+
+def _counting_stream(traffic_data: TrafficData):
+    loads = []
+
+    def load_city(city):
+        loads.append(city)
+        return traffic_data.data[city]
+
+    return MobileData(data=CityDataStream(load_city=load_city, cities=traffic_data.cities())), loads
+
+
+def test_stream_metadata_loads_one_city_once(make_traffic_data):
+    streamed, loads = _counting_stream(traffic_data=make_traffic_data())
+    assert list(streamed.services()) == [s.value for s in SERVICES]
+    assert len(streamed.times()) == 4
+    assert streamed.dtype() == np.float64
+    assert not streamed.is_compact()
+    assert not streamed.is_sparse()
+    assert len(loads) == 1
+
+
+def test_individual_sample_on_stream_loads_each_city_once(make_traffic_data):
+    import robustness
+    streamed, loads = _counting_stream(traffic_data=make_traffic_data())
+    sampler = {s: robustness.get_normal_distribution_sampler(mean=10, std=5) for s in SERVICES}
+    robustness.screen_time_data_sample__individual(traffic_data=streamed, traffic_per_minute_sampler=sampler, rng=np.random.default_rng(0))
+    assert sorted(c.value for c in loads) == sorted(c.value for c in streamed.cities())
+
+
+def test_compact_storage_keeps_nsi_and_rca_within_tolerance(monkeypatch):
+    import engineer_features as ef
+    import transform
+    from mobile_data import ScreenTimeData, COMPACT_RELATIVE_TOLERANCE
+
+    rng = np.random.default_rng(1)
+    cities = list(mt.City)[:2]
+    data = {city: xr.DataArray(rng.lognormal(mean=3, sigma=2, size=(20, 2, 24)), dims=['insee_tile', 'service', 'time'], coords=[[f'{city.value}_{i}' for i in range(20)], [s.value for s in SERVICES], np.arange(24) * 15]) for city in cities}
+    screen_time_data = ScreenTimeData(data=data)
+    compact_screen_time_data = screen_time_data.compact()
+    assert compact_screen_time_data.dtype() == np.float32
+
+    monkeypatch.setattr(ef, 'income_category_insee_tile_codes', lambda insee_tile_codes, income_quantiles: np.array(['low', 'middle', 'high'], dtype=object)[np.arange(len(insee_tile_codes)) % 3])
+
+    nsi = ef.night_screen_index_insee_tile(screen_time_data=screen_time_data)['night_screen_index']
+    compact_nsi = ef.night_screen_index_insee_tile(screen_time_data=compact_screen_time_data)['night_screen_index']
+    np.testing.assert_allclose(compact_nsi.values, nsi.values, rtol=COMPACT_RELATIVE_TOLERANCE, atol=COMPACT_RELATIVE_TOLERANCE * np.abs(nsi.values).max())
+
+    rca = transform.rca_income_and_services(mobile_data=screen_time_data, income_quantiles=[0.3, 0.7])
+    compact_rca = transform.rca_income_and_services(mobile_data=compact_screen_time_data, income_quantiles=[0.3, 0.7])
+    np.testing.assert_allclose(compact_rca.values, rca.values, rtol=COMPACT_RELATIVE_TOLERANCE)
+
+
+def test_insee_tile_codes_follow_stacking_order_and_are_not_pickled(make_traffic_data):
+    traffic_data = make_traffic_data()
+    stacked = traffic_data.stack()
+    codes = traffic_data.insee_tile_codes()
+    np.testing.assert_array_equal(insee_tile_registry.decode(codes=codes), traffic_data.stack_data_along_insee_tile_axis().insee_tile.values)
+    np.testing.assert_array_equal(stacked.insee_tile_codes(), codes)
+    city = traffic_data.cities()[1]
+    np.testing.assert_array_equal(insee_tile_registry.decode(codes=traffic_data.insee_tile_codes(city=city)), traffic_data.data[city].insee_tile.values)
+
+    assert pickle.loads(pickle.dumps(stacked))._insee_tile_codes == {}
+
+
+def test_sparse_round_trip_and_reductions_match_dense(make_traffic_data):
+    pytest.importorskip('sparse')
+    import transform
+
+    # Mostly zeros, as in the night-time traffic the sparse backend is meant for
+    traffic_data = TrafficData(data=make_traffic_data().map_data(fct=lambda data: data.where(data > 70, 0)))
+    for mobile_data in [traffic_data, traffic_data.stack()]:
+        sparse_data = mobile_data.to_sparse()
+        assert sparse_data.is_sparse() and not mobile_data.is_sparse()
+        assert sparse_data.is_stacked() == mobile_data.is_stacked()
+        dense_data = sparse_data.to_dense()
+        assert not dense_data.is_sparse()
+        for city in mobile_data.cities():
+            xr.testing.assert_equal(dense_data.data[city], mobile_data.data[city])
+        np.testing.assert_allclose(transform.mobile_data_by_insee_tile_and_service(mobile_data=sparse_data).values, transform.mobile_data_by_insee_tile_and_service(mobile_data=mobile_data).values)
+
+
+def test_income_grouping_on_stream_loads_each_city_once(monkeypatch, make_traffic_data):
+    import engineer_features as ef
+    import transform
+
+    monkeypatch.setattr(ef, 'income_category_insee_tile_codes', lambda insee_tile_codes, income_quantiles: np.array(['low', 'high'], dtype=object)[np.arange(len(insee_tile_codes)) % 2])
+    for group in [transform.mobile_data_by_income_service_time_and_city, transform.mobile_data_by_income_service_and_time]:
+        streamed, loads = _counting_stream(traffic_data=make_traffic_data())
+        group(mobile_data=streamed, income_quantiles=[0.5])
+        assert sorted(c.value for c in loads) == sorted(c.value for c in streamed.cities())
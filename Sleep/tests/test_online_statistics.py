@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+import transform
+from online_statistics import OnlineStatistics
+
+
+def test_cells_with_fewer_than_two_values_block_convergence():
+    statistics = OnlineStatistics()
+    index = pd.Index(['low', 'middle', 'high'])
+    for value in [1.0, 1.0, 1.0]:
+        statistics.update(sample=pd.Series([value, value, np.nan], index=index))
+    statistics.update(sample=pd.Series([1.0, 1.0, 2.0], index=index))
+
+    standard_error = statistics.standard_error()
+    assert standard_error['low'] == 0
+    assert standard_error['high'] == np.inf
+    assert statistics.max_standard_error() == np.inf
+    assert statistics.n_cells_without_precision() == 1
+
+
+def test_stop_rule_checks_precision_once_per_batch_and_reports_it():
+    stop = transform._StopWhenConverged(target_standard_error=0.1, batch_size=2)
+    statistics = OnlineStatistics()
+    index = pd.Index(['low', 'high'])
+    samples = [pd.Series([1.0, 5.0], index=index), pd.Series([1.0, 5.0], index=index), pd.Series([1.0, 5.0], index=index)]
+
+    stopped_at = None
+    for k, sample in enumerate(samples):
+        statistics.update(sample=sample)
+        if stop(statistics):
+            stopped_at = k + 1
+            break
+
+    assert stopped_at == 2
+    report = stop.report(statistics=statistics)
+    assert report['converged'] and report['n_samples'] == 2 and report['max_standard_error'] == 0 and report['n_cells_without_precision'] == 0
+
+
+def test_stop_rule_stops_on_time_budget_without_convergence():
+    stop = transform._StopWhenConverged(target_standard_error=1e-12, batch_size=1, max_time_s=-1)
+    statistics = OnlineStatistics()
+    statistics.update(sample=pd.Series([1.0, 2.0]))
+    statistics.update(sample=pd.Series([3.0, 5.0]))
+    assert stop(statistics)
+    assert not stop.report(statistics=statistics)['converged']
+
+
+def test_welford_matches_pandas_with_nans():
+    rng = np.random.default_rng(0)
+    samples = pd.DataFrame(rng.normal(size=(4, 50)), index=['a', 'b', 'c', 'd'])
+    samples.iloc[1, ::3] = np.nan
+    samples.iloc[3, 1:] = np.nan
+
+    statistics = OnlineStatistics()
+    for column in samples.columns:
+        statistics.update(sample=samples[column])
+
+    np.testing.assert_allclose(statistics.mean().values, samples.mean(axis=1).values)
+    np.testing.assert_allclose(statistics.std().values, samples.std(axis=1).values, equal_nan=True)
+    assert statistics.n_samples().tolist() == samples.notna().sum(axis=1).tolist()
+
+
+def test_reservoir_quantiles_are_exact_below_reservoir_size_and_close_above():
+    rng = np.random.default_rng(0)
+    samples = rng.normal(size=(2, 5000))
+    small, large = OnlineStatistics(quantiles=[0.5], reservoir_size=5000, seed=0), OnlineStatistics(quantiles=[0.5], reservoir_size=500, seed=0)
+    for k in range(samples.shape[1]):
+        small.update(sample=pd.Series(samples[:, k]))
+        large.update(sample=pd.Series(samples[:, k]))
+
+    np.testing.assert_allclose(small.quantile(0.5).values, np.quantile(samples, 0.5, axis=1))
+    np.testing.assert_allclose(large.quantile(0.5).values, np.quantile(samples, 0.5, axis=1), atol=0.2)
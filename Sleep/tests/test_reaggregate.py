@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import xarray as xr
+import netCDF4
+import pytest
+
+import mobile_traffic as mt
+import aggregate_geo
+
+
+NETMOB_TILES = pd.Index(['n0', 'n1', 'n2'])
+INSEE_TILES = pd.Index(['i0', 'i1'], name='insee_tile')
+# n1 is split between both insee tiles, a third of n2 falls in i3, which is not covered enough to be kept
+WEIGHTS = sp.csr_matrix(np.array([[1.0, 0.5, 0.0], [0.0, 0.5, 2 / 3]]))
+MATCHING_NETMOB_TILE_TO_INSEE_TILE = pd.DataFrame({
+    'netmob_tile': ['n0', 'n1', 'n1', 'n2', 'n2'],
+    'insee_tile': ['i0', 'i0', 'i1', 'i1', 'i3'],
+    'intersection_area': [10000.0, 5000.0, 5000.0, 20000 / 3, 10000 / 3],
+})
+
+
+def _set_weights(monkeypatch, weights):
+    monkeypatch.setattr(aggregate_geo, 'get_covered_weights_netmob_tile_to_insee_tile', lambda city_netmob_tile, netmob_tiles: (weights, INSEE_TILES))
+
+
+@pytest.fixture
+def covered_weights(monkeypatch):
+    monkeypatch.setattr(aggregate_geo, 'get_matching_netmob_tile_to_insee_tile', lambda city_netmob_tile: MATCHING_NETMOB_TILE_TO_INSEE_TILE)
+    _set_weights(monkeypatch=monkeypatch, weights=WEIGHTS)
+
+
+def _write_source(path, values):
+    data = xr.DataArray(values, dims=['tile_id', 'service', 'time'], coords=[NETMOB_TILES, ['a', 'b'], ['22:00:00', '22:15:00']])
+    data.to_netcdf(path)
+    return data
+
+
+def _read_target(path):
+    with netCDF4.Dataset(path, 'r') as target:
+        return np.asarray(target['__xarray_dataarray_variable__'][:])
+
+
+def test_reaggregate_patches_only_selected_slice_with_nan_in_source(tmp_path, covered_weights):
+    source_path, target_path = str(tmp_path / 'source.nc'), str(tmp_path / 'target.nc')
+    values = np.arange(12, dtype=np.float64).reshape(3, 2, 2)
+    _write_source(path=source_path, values=values)
+    aggregate_geo.aggregate_netmob_tile_level_traffic_data_file_to_insee_tile_level(source_file_path=source_path, target_file_path=target_path, city=mt.City.PARIS)
+    before = _read_target(path=target_path)
+
+    changed = values * 10
+    changed[1, 1, 0] = np.nan
+    _write_source(path=source_path, values=changed)
+    error = aggregate_geo.reaggregate_netmob_tile_level_traffic_data_file_to_insee_tile_level(source_file_path=source_path, target_file_path=target_path, city=mt.City.PARIS, services=['b'])
+
+    after = _read_target(path=target_path)
+    # The missing value of n1 makes both insee tiles it overlaps missing at that time
+    expected = WEIGHTS @ changed[:, 1, :]
+    assert np.isnan(expected[:, 0]).all()
+    assert error < 1e-12
+    np.testing.assert_allclose(after[:, 1, :], expected)
+    np.testing.assert_array_equal(after[:, 0, :], before[:, 0, :])
+
+
+def test_reaggregate_leaves_target_untouched_when_mass_check_fails(tmp_path, covered_weights, monkeypatch):
+    source_path, target_path = str(tmp_path / 'source.nc'), str(tmp_path / 'target.nc')
+    values = np.broadcast_to(np.array([1.0, 2.0, 3.0])[:, np.newaxis, np.newaxis], (3, 2, 2)).copy()
+    _write_source(path=source_path, values=values)
+    aggregate_geo.aggregate_netmob_tile_level_traffic_data_file_to_insee_tile_level(source_file_path=source_path, target_file_path=target_path, city=mt.City.PARIS)
+    before = _read_target(path=target_path)
+
+    # Weights whose netmob tile order is off by one do not conserve the traffic given by the matching
+    _write_source(path=source_path, values=values * 5)
+    _set_weights(monkeypatch=monkeypatch, weights=sp.csr_matrix(WEIGHTS.toarray()[:, [2, 0, 1]]))
+    with pytest.raises(ValueError):
+        aggregate_geo.reaggregate_netmob_tile_level_traffic_data_file_to_insee_tile_level(source_file_path=source_path, target_file_path=target_path, city=mt.City.PARIS, services=['a'])
+    np.testing.assert_array_equal(_read_target(path=target_path), before)
+
+
+def test_reaggregate_restores_target_when_patched_slab_does_not_conserve_traffic(tmp_path, covered_weights, monkeypatch):
+    source_path, target_path = str(tmp_path / 'source.nc'), str(tmp_path / 'target.nc')
+    values = np.arange(12, dtype=np.float64).reshape(3, 2, 2) + 1
+    _write_source(path=source_path, values=values)
+    aggregate_geo.aggregate_netmob_tile_level_traffic_data_file_to_insee_tile_level(source_file_path=source_path, target_file_path=target_path, city=mt.City.PARIS)
+    before = _read_target(path=target_path)
+
+    # Only the check of the slab read back from disk fails
+    mass_conservation_error = aggregate_geo.mass_conservation_error
+    errors = iter([None, 1.0])
+    monkeypatch.setattr(aggregate_geo, 'mass_conservation_error', lambda **kwargs: next(errors) or mass_conservation_error(**kwargs))
+    _write_source(path=source_path, values=values * 5)
+    with pytest.raises(ValueError, match='restored'):
+        aggregate_geo.reaggregate_netmob_tile_level_traffic_data_file_to_insee_tile_level(source_file_path=source_path, target_file_path=target_path, city=mt.City.PARIS, services=['a'])
+    np.testing.assert_array_equal(_read_target(path=target_path), before)
+
+
+def test_mass_conservation_error_uses_the_matching_and_propagates_nan():
+    source = xr.DataArray(np.array([[[np.nan], [1.0]], [[4.0], [2.0]], [[3.0], [6.0]]]), dims=['tile_id', 'service', 'time'], coords=[NETMOB_TILES, ['a', 'b'], ['22:00:00']])
+    covered_share = pd.Series({'n0': 1.0, 'n1': 1.0, 'n2': 2 / 3})
+    aggregated = aggregate_geo.aggregate_with_weights(data=source, weights=WEIGHTS, target_tiles=INSEE_TILES, source_dim='tile_id', target_dim='insee_tile')
+    assert np.isnan(aggregated.sel(service='a').values).tolist() == [[True], [False]]
+    assert aggregate_geo.mass_conservation_error(traffic_data_netmob_tile=source, traffic_data_insee_tile=aggregated.values, covered_share=covered_share) < 1e-12
+
+    wrong_weights = sp.csr_matrix(WEIGHTS.toarray()[:, [2, 0, 1]])
+    wrong = aggregate_geo.aggregate_with_weights(data=source.fillna(0), weights=wrong_weights, target_tiles=INSEE_TILES, source_dim='tile_id', target_dim='insee_tile')
+    assert aggregate_geo.mass_conservation_error(traffic_data_netmob_tile=source.fillna(0), traffic_data_insee_tile=wrong.values, covered_share=covered_share) > 1e-3
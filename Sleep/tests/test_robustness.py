@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+import mobile_traffic as mt
+import robustness
+
+
+SAMPLER = {mt.Service.YOUTUBE: robustness.get_normal_distribution_sampler(mean=10, std=5), mt.Service.NETFLIX: robustness.get_normal_distribution_sampler(mean=15, std=5)}
+
+
+@pytest.fixture
+def traffic_data(make_traffic_data):
+    # The second city has much more traffic, so a shared draw sized on the global maximum would differ from per-city draws
+    return make_traffic_data(city_scale=10)
+
+
+@pytest.fixture
+def income_category(monkeypatch):
+    import engineer_features as ef
+    monkeypatch.setattr(ef, 'income_category_insee_tile_codes', lambda insee_tile_codes, income_quantiles: np.array(['q0', 'q1', 'q2'], dtype=object)[np.asarray(insee_tile_codes) % 3])
+
+
+@pytest.mark.parametrize('sampling_technique', list(robustness.SamplingTechnique))
+def test_batched_samples_match_per_sample_dict(traffic_data, sampling_technique):
+    samples = robustness.get_screen_time_data_samples(traffic_data=traffic_data, n_samples=3, traffic_per_minute_sampler=SAMPLER, sampling_technique=sampling_technique, seed=7)
+    batched = robustness.get_screen_time_data_samples__batched(traffic_data=traffic_data, n_samples=3, traffic_per_minute_sampler=SAMPLER, sampling_technique=sampling_technique, seed=7)
+    stacked = batched.stack_data_along_insee_tile_axis()
+    for sample_name, sample in samples.items():
+        np.testing.assert_array_equal(stacked.sel(sample=sample_name).values, sample.stack_data_along_insee_tile_axis().values)
+
+
+@pytest.mark.parametrize('sampling_technique', list(robustness.SamplingTechnique))
+def test_seeded_samples_do_not_depend_on_the_number_of_workers(traffic_data, sampling_technique):
+    def samples(seed, n_workers):
+        return robustness.get_screen_time_data_samples(traffic_data=traffic_data, n_samples=4, traffic_per_minute_sampler=SAMPLER, sampling_technique=sampling_technique, seed=seed, n_workers=n_workers, reduce=robustness.reduce_to_insee_tile_and_service)
+
+    serial, parallel, other_seed = samples(seed=3, n_workers=1), samples(seed=3, n_workers=2), samples(seed=4, n_workers=1)
+    assert list(serial) == list(parallel)
+    for sample_name in serial:
+        np.testing.assert_array_equal(serial[sample_name].values, parallel[sample_name].values)
+    assert not np.array_equal(serial['0'].values, other_seed['0'].values)
+    assert not np.array_equal(serial['0'].values, serial['1'].values)
+
+
+@pytest.mark.parametrize('sampling_technique', list(robustness.SamplingTechnique))
+def test_batched_nsi_and_rca_match_per_sample_results(traffic_data, sampling_technique, income_category):
+    kwargs = dict(traffic_data=traffic_data, n_samples=3, traffic_per_minute_sampler=SAMPLER, sampling_technique=sampling_technique, seed=11)
+    nsi = robustness.night_screen_index_samples__screen_time(batched=False, **kwargs)
+    batched_nsi = robustness.night_screen_index_samples__screen_time(batched=True, **kwargs)
+    assert list(batched_nsi.columns) == list(nsi.columns)
+    np.testing.assert_allclose(batched_nsi.loc[nsi.index].values, nsi.values)
+
+    rca = robustness.rca_income_and_service_samples__screen_time(batched=False, income_quantiles=[0.3, 0.7], **kwargs)
+    batched_rca = robustness.rca_income_and_service_samples__screen_time(batched=True, income_quantiles=[0.3, 0.7], **kwargs)
+    batched_rca = batched_rca.sel(income_category=rca.income_category.values, service=rca.service.values, sample=rca.sample.values).transpose(*rca.dims)
+    np.testing.assert_allclose(batched_rca.values, rca.values)
@@ -0,0 +1,29 @@
+from datetime import time
+
+import numpy as np
+import pytest
+
+import time_axis
+
+
+def test_labels_round_trip_through_minutes():
+    labels = np.array(['22:00:00', '23:45:00', '00:00:00', '07:15:00', '21:59:00'])
+    minutes = time_axis.labels_to_minutes(labels=labels)
+    np.testing.assert_array_equal(minutes, [0, 105, 120, 555, 1439])
+    np.testing.assert_array_equal(time_axis.minutes_to_labels(minutes=minutes), labels)
+    assert time_axis.minutes_to_times(minutes=minutes) == [time(22), time(23, 45), time(0), time(7, 15), time(21, 59)]
+    np.testing.assert_array_equal(time_axis.times_to_minutes(times=time_axis.minutes_to_times(minutes=minutes)), minutes)
+
+
+def test_labels_use_the_reference_time():
+    np.testing.assert_array_equal(time_axis.labels_to_minutes(labels=['00:00:00', '23:30:00'], reference_time=time(0)), [0, 1410])
+
+
+def test_sort_labels_starts_at_the_reference_time():
+    assert time_axis.sort_labels(labels=['01:00:00', '22:15:00', '23:00:00']) == ['22:15:00', '23:00:00', '01:00:00']
+
+
+@pytest.mark.parametrize('label', ['7:15:00', '07:15', '07:15:00:00', '07-15-00', '0a:15:00', '24:00:00', '07:60:00', ''])
+def test_malformed_labels_are_rejected(label):
+    with pytest.raises(ValueError):
+        time_axis.labels_to_minutes(labels=['22:00:00', label])
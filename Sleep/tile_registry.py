@@ -0,0 +1,35 @@
+from typing import Dict, List, Union
+
+import numpy as np
+import pandas as pd
+
+
+class TileRegistry:
+    # Codes are assigned in order of first appearance and are only valid within the process that created them
+    def __init__(self):
+        self._tiles = pd.Index([], dtype=object)
+
+    def encode(self, tiles: Union[List[str], np.ndarray, pd.Index]) -> np.ndarray:
+        tiles = pd.Index(tiles)
+        new_tiles = tiles.unique().difference(self._tiles, sort=False)
+        if len(new_tiles) > 0:
+            self._tiles = self._tiles.append(new_tiles)
+        return self._tiles.get_indexer(tiles).astype(np.int32)
+
+    def decode(self, codes: Union[List[int], np.ndarray, pd.Index]) -> np.ndarray:
+        return self._tiles.values[np.asarray(codes, dtype=np.int32)]
+
+    def __len__(self) -> int:
+        return len(self._tiles)
+
+
+_registries: Dict[str, TileRegistry] = {}
+
+
+def get_registry(name: str) -> TileRegistry:
+    if name not in _registries:
+        _registries[name] = TileRegistry()
+    return _registries[name]
+
+
+insee_tile_registry = get_registry(name='insee_tile')
@@ -0,0 +1,57 @@
+from datetime import time
+from typing import List, Union
+
+import numpy as np
+import xarray as xr
+
+NIGHT_REFERENCE_TIME = time(22)
+MINUTES_PER_DAY = 24 * 60
+
+
+def minutes_of_day(t: time) -> int:
+    return t.hour * 60 + t.minute
+
+
+def labels_to_minutes(labels: Union[List[str], np.ndarray], reference_time: time = NIGHT_REFERENCE_TIME) -> np.ndarray:
+    # Labels are fixed width 'HH:MM:SS' strings, so hours and minutes are read directly from the character codes
+    labels = np.asarray(labels).astype(str).ravel()
+    if not (np.char.str_len(labels) == 8).all():
+        raise ValueError(f'Time labels must be HH:MM:SS strings, got {labels[np.char.str_len(labels) != 8][0]!r}')
+    characters = labels.astype('U8').view(np.int32).reshape(-1, 8) - ord('0')
+    separators = characters[:, [2, 5]] == ord(':') - ord('0')
+    digits = characters[:, [0, 1, 3, 4, 6, 7]]
+    valid = separators.all(axis=1) & ((digits >= 0) & (digits <= 9)).all(axis=1) & (digits[:, 0] * 10 + digits[:, 1] < 24) & (digits[:, 2] < 6) & (digits[:, 4] < 6)
+    if not valid.all():
+        raise ValueError(f'Time labels must be HH:MM:SS strings, got {labels[~valid][0]!r}')
+    minutes = (digits[:, 0] * 10 + digits[:, 1]) * 60 + digits[:, 2] * 10 + digits[:, 3]
+    return ((minutes - minutes_of_day(t=reference_time)) % MINUTES_PER_DAY).astype(np.int32)
+
+
+def times_to_minutes(times: List[time], reference_time: time = NIGHT_REFERENCE_TIME) -> np.ndarray:
+    minutes = np.array([minutes_of_day(t=t) for t in times])
+    return ((minutes - minutes_of_day(t=reference_time)) % MINUTES_PER_DAY).astype(np.int32)
+
+
+def minutes_to_labels(minutes: Union[List[int], np.ndarray], reference_time: time = NIGHT_REFERENCE_TIME) -> np.ndarray:
+    minutes = (np.asarray(minutes) + minutes_of_day(t=reference_time)) % MINUTES_PER_DAY
+    hours = np.char.zfill((minutes // 60).astype(str), 2)
+    minutes = np.char.zfill((minutes % 60).astype(str), 2)
+    return np.char.add(np.char.add(np.char.add(hours, ':'), minutes), ':00')
+
+
+def minutes_to_times(minutes: Union[List[int], np.ndarray], reference_time: time = NIGHT_REFERENCE_TIME) -> List[time]:
+    minutes = (np.asarray(minutes) + minutes_of_day(t=reference_time)) % MINUTES_PER_DAY
+    return [time(m // 60, m % 60) for m in minutes.tolist()]
+
+
+def sort_labels(labels: Union[List[str], np.ndarray], reference_time: time = NIGHT_REFERENCE_TIME) -> List[str]:
+    order = np.argsort(labels_to_minutes(labels=labels, reference_time=reference_time), kind='stable')
+    return list(np.asarray(labels)[order])
+
+
+def coarsen(data: xr.DataArray, resolution_minutes: int) -> xr.DataArray:
+    if resolution_minutes < 1 or resolution_minutes > 60 or 60 % resolution_minutes != 0:
+        raise ValueError(f'Resolution must divide 60 minutes, got {resolution_minutes}')
+    data = data.assign_coords(time=(data.time // resolution_minutes) * resolution_minutes)
+    data = data.groupby('time').sum()
+    return data
@@ -1,4 +1,5 @@
-from typing import Dict, List, Tuple, Union
+import time
+from typing import Dict, List, Tuple, Union, Iterator, Callable, Any
 
 import engineer_features as ef
 import pandas as pd
@@ -8,7 +9,9 @@ import geopandas as gpd
 
 import mobile_traffic as mt
 import insee
-from mobile_data import MobileData, ScreenTimeData, TrafficData
+from mobile_data import MobileData, ScreenTimeData, TrafficData, ACCUMULATION_DTYPE, densify
+from tile_registry import insee_tile_registry
+from online_statistics import OnlineStatistics
 import robustness
 
 
@@ -28,27 +31,71 @@ def night_screen_index_and_log2_income(screen_time_data: ScreenTimeData) -> pd.D
     return nsi_and_income
 
 
-def night_screen_index_and_log2_income_robustness__screen_time(traffic_data: TrafficData, income_quantiles: List[float], n_samples: int, sampling_technique) -> pd.DataFrame:
-    nsi_samples = robustness.night_screen_index_samples__screen_time(traffic_data=traffic_data, n_samples=n_samples, traffic_per_minute_sampler=robustness.service_traffic_per_minute_sampler(), sampling_technique=sampling_technique)
-    nsi_samples_grouped_by_income = _group_night_screen_index_samples_by_income_category(nsi_samples=nsi_samples, income_quantiles=income_quantiles)
-    nsi_samples_mean = nsi_samples_grouped_by_income.mean(axis=1).to_frame('mean')
-    nsi_samples_std = nsi_samples_grouped_by_income.std(axis=1).to_frame('std')
-    nsi_samples_mean_and_std_per_income_category = pd.concat([nsi_samples_mean, nsi_samples_std], axis=1)
-    nsi_samples_mean_and_std_per_income_category.index = nsi_samples_grouped_by_income.index
-    return nsi_samples_mean_and_std_per_income_category
-
-
-def night_screen_index_and_log2_income_robustness__amenity(screen_time_data: ScreenTimeData, income_quantiles: List[float]) -> pd.DataFrame:
-    nsi_samples = robustness.night_screen_index_samples__amenity(screen_time_data=screen_time_data, thresholds_and_buffers=robustness.thresholds_and_buffers_amenities())
+def night_screen_index_and_log2_income_robustness__screen_time(traffic_data: TrafficData, income_quantiles: List[float], n_samples: int, sampling_technique, batched: bool = False, seed: int = None, n_workers: int = 1, quantiles: List[float] = None) -> pd.DataFrame:
+    if batched:
+        # The batched mode holds every sample in memory to compute them in one vectorised pass, so its statistics are
+        # computed directly on the samples rather than streamed
+        nsi_samples = robustness.night_screen_index_samples__screen_time(traffic_data=traffic_data, n_samples=n_samples, traffic_per_minute_sampler=robustness.service_traffic_per_minute_sampler(), sampling_technique=sampling_technique, batched=batched, seed=seed)
+        nsi_samples_grouped_by_income = _group_night_screen_index_samples_by_income_category(nsi_samples=nsi_samples, income_quantiles=income_quantiles)
+        nsi_samples_statistics = [nsi_samples_grouped_by_income.mean(axis=1).rename('mean'), nsi_samples_grouped_by_income.std(axis=1).rename('std')]
+        nsi_samples_statistics += [nsi_samples_grouped_by_income.quantile(q, axis=1).rename(f'q{q}') for q in ([] if quantiles is None else quantiles)]
+        return pd.concat(nsi_samples_statistics, axis=1)
+
+    nsi_samples = robustness.iter_screen_time_data_samples(traffic_data=traffic_data, n_samples=n_samples, traffic_per_minute_sampler=robustness.service_traffic_per_minute_sampler(), sampling_technique=sampling_technique, seed=seed, n_workers=n_workers, reduce=robustness.reduce_to_night_screen_index)
+    nsi_samples_statistics = night_screen_index_by_income_category_statistics(nsi_samples=nsi_samples, income_quantiles=income_quantiles, quantiles=quantiles, seed=seed)
+    return nsi_samples_statistics.to_frame()
+
+
+def night_screen_index_and_log2_income_robustness__screen_time__adaptive(traffic_data: TrafficData, income_quantiles: List[float], sampling_technique, target_standard_error: float, batch_size: int = 8, max_samples: int = 1000, max_time_s: float = None, seed: int = None, n_workers: int = 1, quantiles: List[float] = None) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    nsi_samples = robustness.iter_screen_time_data_samples(traffic_data=traffic_data, n_samples=max_samples, traffic_per_minute_sampler=robustness.service_traffic_per_minute_sampler(), sampling_technique=sampling_technique, seed=seed, n_workers=n_workers, reduce=robustness.reduce_to_night_screen_index)
+    stop = _StopWhenConverged(target_standard_error=target_standard_error, batch_size=batch_size, max_time_s=max_time_s)
+    nsi_samples_statistics = night_screen_index_by_income_category_statistics(nsi_samples=nsi_samples, income_quantiles=income_quantiles, quantiles=quantiles, seed=seed, stop=stop)
+    nsi_samples.close()
+    return nsi_samples_statistics.to_frame(precision=True), stop.report(statistics=nsi_samples_statistics)
+
+
+def night_screen_index_by_income_category_statistics(nsi_samples: Iterator[pd.Series], income_quantiles: List[float], quantiles: List[float] = None, seed: int = None, stop: Callable[[OnlineStatistics], bool] = None) -> OnlineStatistics:
+    # Each sample is folded into the statistics and dropped, so memory does not grow with the number of samples
+    nsi_samples_statistics = OnlineStatistics(quantiles=quantiles, seed=seed)
+    income_category = None
+    for night_screen_index in nsi_samples:
+        if income_category is None:
+            income_category = income_category_of_insee_tiles(insee_tiles=night_screen_index.index, income_quantiles=income_quantiles)
+        nsi_samples_statistics.update(sample=night_screen_index.groupby(income_category).agg(func=mean_without_nans))
+        if stop is not None and stop(nsi_samples_statistics):
+            break
+    return nsi_samples_statistics
+
+
+class _StopWhenConverged:
+    # Checked after every sample, but the precision is only evaluated once per batch
+    def __init__(self, target_standard_error: float, batch_size: int, max_time_s: float = None):
+        self.target_standard_error = target_standard_error
+        self.batch_size = batch_size
+        self.max_time_s = max_time_s
+        self.start = time.monotonic()
+
+    def __call__(self, statistics: OnlineStatistics) -> bool:
+        if statistics.n_updates % self.batch_size != 0:
+            return False
+        converged = statistics.max_standard_error() <= self.target_standard_error
+        out_of_time = self.max_time_s is not None and time.monotonic() - self.start > self.max_time_s
+        return converged or out_of_time
+
+    def report(self, statistics: OnlineStatistics) -> Dict[str, Any]:
+        max_standard_error = statistics.max_standard_error()
+        return {'n_samples': statistics.n_updates, 'max_standard_error': max_standard_error, 'target_standard_error': self.target_standard_error, 'converged': max_standard_error <= self.target_standard_error, 'n_cells_without_precision': statistics.n_cells_without_precision(), 'elapsed_s': time.monotonic() - self.start}
+
+
+def night_screen_index_and_log2_income_robustness__amenity(screen_time_data: ScreenTimeData, income_quantiles: List[float], n_workers: int = 1) -> pd.DataFrame:
+    nsi_samples = robustness.night_screen_index_samples__amenity(screen_time_data=screen_time_data, thresholds_and_buffers=robustness.thresholds_and_buffers_amenities(), n_workers=n_workers)
     nsi_samples_grouped_by_income = _group_night_screen_index_samples_by_income_category(nsi_samples=nsi_samples, income_quantiles=income_quantiles)
     return nsi_samples_grouped_by_income
 
 
 def _group_night_screen_index_samples_by_income_category(nsi_samples: pd.DataFrame, income_quantiles: List[float]) -> pd.DataFrame:
-    map_insee_tile_to_income_category = ef.map_insee_tile_to_income_category(insee_tiles=list(nsi_samples.index), income_quantiles=income_quantiles)
-    income_category = pd.Series(map_insee_tile_to_income_category, name='income_category')
-    nsi_samples_and_income = nsi_samples.merge(income_category, left_index=True, right_index=True)
-    nsi_samples_grouped_by_income = nsi_samples_and_income.groupby('income_category').agg(func=mean_without_nans)
+    income_category = income_category_of_insee_tiles(insee_tiles=nsi_samples.index, income_quantiles=income_quantiles)
+    nsi_samples_grouped_by_income = nsi_samples.groupby(income_category).agg(func=mean_without_nans)
     return nsi_samples_grouped_by_income
 
 
@@ -111,13 +158,34 @@ def rca_insee_tile_service_and_tile_geo(mobile_data: MobileData) -> gpd.GeoDataF
     return rca_and_tile_geo
 
 
-def rca_income_and_services_robustness__screen_time(traffic_data: TrafficData, income_quantiles: List[float], n_samples: int, sampling_technique) -> xr.DataArray:
-    rca_samples = robustness.rca_income_and_service_samples__screen_time(traffic_data=traffic_data, income_quantiles=income_quantiles, n_samples=n_samples, traffic_per_minute_sampler=robustness.service_traffic_per_minute_sampler(), sampling_technique=sampling_technique)
+def rca_income_and_services_robustness__screen_time(traffic_data: TrafficData, income_quantiles: List[float], n_samples: int, sampling_technique, batched: bool = False, seed: int = None, n_workers: int = 1) -> xr.DataArray:
+    rca_samples = robustness.rca_income_and_service_samples__screen_time(traffic_data=traffic_data, income_quantiles=income_quantiles, n_samples=n_samples, traffic_per_minute_sampler=robustness.service_traffic_per_minute_sampler(), sampling_technique=sampling_technique, batched=batched, seed=seed, n_workers=n_workers)
     return rca_samples
 
 
-def rca_income_and_services_robustness__amenity(screen_time_data: MobileData, income_quantiles: List[float]) -> xr.DataArray:
-    rca_samples = robustness.rca_income_and_service_samples__amenity(mobile_data=screen_time_data, income_quantiles=income_quantiles, thresholds_and_buffers=robustness.thresholds_and_buffers_amenities())
+def rca_income_and_services_robustness__screen_time__adaptive(traffic_data: TrafficData, income_quantiles: List[float], sampling_technique, target_standard_error: float, batch_size: int = 8, max_samples: int = 1000, max_time_s: float = None, seed: int = None, n_workers: int = 1, quantiles: List[float] = None) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    md_by_insee_tile_and_service_samples = robustness.iter_screen_time_data_samples(traffic_data=traffic_data, n_samples=max_samples, traffic_per_minute_sampler=robustness.service_traffic_per_minute_sampler(), sampling_technique=sampling_technique, seed=seed, n_workers=n_workers, reduce=robustness.reduce_to_insee_tile_and_service)
+    stop = _StopWhenConverged(target_standard_error=target_standard_error, batch_size=batch_size, max_time_s=max_time_s)
+    rca_samples_statistics = rca_income_and_services_statistics(md_by_insee_tile_and_service_samples=md_by_insee_tile_and_service_samples, income_quantiles=income_quantiles, quantiles=quantiles, seed=seed, stop=stop)
+    md_by_insee_tile_and_service_samples.close()
+    return rca_samples_statistics.to_frame(precision=True), stop.report(statistics=rca_samples_statistics)
+
+
+def rca_income_and_services_statistics(md_by_insee_tile_and_service_samples: Iterator[pd.DataFrame], income_quantiles: List[float], quantiles: List[float] = None, seed: int = None, stop: Callable[[OnlineStatistics], bool] = None) -> OnlineStatistics:
+    rca_samples_statistics = OnlineStatistics(quantiles=quantiles, seed=seed)
+    income_category = None
+    for md_by_insee_tile_and_service in md_by_insee_tile_and_service_samples:
+        if income_category is None:
+            income_category = income_category_of_insee_tiles(insee_tiles=md_by_insee_tile_and_service.index, income_quantiles=income_quantiles)
+        md_by_income_and_service = md_by_insee_tile_and_service.groupby(income_category).mean()
+        rca_samples_statistics.update(sample=compute_rca(df=md_by_income_and_service).stack())
+        if stop is not None and stop(rca_samples_statistics):
+            break
+    return rca_samples_statistics
+
+
+def rca_income_and_services_robustness__amenity(screen_time_data: MobileData, income_quantiles: List[float], n_workers: int = 1) -> xr.DataArray:
+    rca_samples = robustness.rca_income_and_service_samples__amenity(mobile_data=screen_time_data, income_quantiles=income_quantiles, thresholds_and_buffers=robustness.thresholds_and_buffers_amenities(), n_workers=n_workers)
     return rca_samples
 
 
@@ -139,7 +207,9 @@ def service_space(mobile_data: MobileData) -> pd.DataFrame:
 def mobile_data_by_income_service_time_and_city(mobile_data: MobileData, income_quantiles: List[float]) -> xr.DataArray:
     md_by_income_service_and_time = []
     for city in mobile_data.cities():
-        md_city_by_income_service_and_time = group_insee_tile_by_income(data=mobile_data.data[city], income_quantiles=income_quantiles)
+        # Fetched once, a streamed city is loaded on every access
+        data_city = mobile_data.data[city]
+        md_city_by_income_service_and_time = group_insee_tile_by_income(data=data_city, income_quantiles=income_quantiles)
         md_city_by_income_service_and_time = md_city_by_income_service_and_time.expand_dims(dim={'city': [city]})
         md_by_income_service_and_time.append(md_city_by_income_service_and_time)
 
@@ -147,18 +217,28 @@ def mobile_data_by_income_service_time_and_city(mobile_data: MobileData, income_
     return td_by_income_service_time_and_city
 
 
-def group_insee_tile_by_income(data: xr.DataArray, income_quantiles: List[float]):
-    insee_tiles = list(data.insee_tile.values)
-    map_insee_tile_to_income_category = ef.map_insee_tile_to_income_category(insee_tiles=insee_tiles, income_quantiles=income_quantiles)
-    data = data.assign_coords(insee_tile=[map_insee_tile_to_income_category[insee_tile] for insee_tile in insee_tiles])
+def income_category_of_insee_tiles(insee_tiles: pd.Index, income_quantiles: List[float]) -> pd.Series:
+    insee_tile_codes = insee_tile_registry.encode(tiles=insee_tiles)
+    income_category = ef.income_category_insee_tile_codes(insee_tile_codes=insee_tile_codes, income_quantiles=income_quantiles)
+    return pd.Series(income_category, index=insee_tiles, name='income_category')
+
+
+def group_insee_tile_by_income(data: xr.DataArray, income_quantiles: List[float], income_category: np.ndarray = None):
+    if income_category is None:
+        insee_tile_codes = insee_tile_registry.encode(tiles=data.insee_tile.values)
+        income_category = ef.income_category_insee_tile_codes(insee_tile_codes=insee_tile_codes, income_quantiles=income_quantiles)
+    data = data.assign_coords(insee_tile=income_category)
     data = data.rename({'insee_tile': 'income_category'})
-    data = data.groupby('income_category').mean()
+    data = densify(data=data.groupby('income_category').mean(dtype=ACCUMULATION_DTYPE))
     return data
 
 
 def mobile_data_by_income_service_and_time(mobile_data: MobileData, income_quantiles: List[float]) -> xr.DataArray:
+    # Stacking first loads a streamed dataset once, and lets the tile codes be read from the stacked array
+    mobile_data = mobile_data.stack()
     stacked_mobile_data = mobile_data.stack_data_along_insee_tile_axis()
-    md_by_income_service_and_time = group_insee_tile_by_income(data=stacked_mobile_data, income_quantiles=income_quantiles)
+    income_category = ef.income_category_insee_tile_codes(insee_tile_codes=mobile_data.insee_tile_codes(), income_quantiles=income_quantiles)
+    md_by_income_service_and_time = group_insee_tile_by_income(data=stacked_mobile_data, income_quantiles=income_quantiles, income_category=income_category)
     return md_by_income_service_and_time
 
 
@@ -176,7 +256,7 @@ def screen_time_data_by_income_and_time(screen_time_data: ScreenTimeData, income
 
 def mobile_data_by_insee_tile_and_service(mobile_data: MobileData) -> pd.DataFrame:
     stacked_mobile_data = mobile_data.stack_data_along_insee_tile_axis()
-    md_by_insee_tile_and_service = stacked_mobile_data.sum(dim='time').to_pandas()
+    md_by_insee_tile_and_service = densify(data=stacked_mobile_data.sum(dim='time', dtype=ACCUMULATION_DTYPE)).to_pandas()
     return md_by_insee_tile_and_service
 
 